@@ -0,0 +1,177 @@
+"""
+Checks that the memoryview metadata decoder (libvistier.nfts.MetadataAccount) returns exactly the dict of the
+byte-by-byte unpacker it replaced, then times both on the same generated accounts.
+
+Run from the repository root:
+    python benchmarks/metadata_unpack.py [--accounts 2000] [--creators 3] [--repeat 5] [--seed 0]
+"""
+import os
+import sys
+import time
+import random
+import struct
+import argparse
+
+import base58
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from libvistier import nfts  # noqa: E402
+
+
+# unpack_metadata_account as it was before MetadataAccount, taken from Metaplex python library
+def legacy_unpack_metadata_account(data: bytes) -> dict:
+    assert(data[0] == 4)
+    i = 1
+    source_account = base58.b58encode(bytes(struct.unpack('<' + "B"*32, data[i:i+32])))
+    i += 32
+    mint_account = base58.b58encode(bytes(struct.unpack('<' + "B"*32, data[i:i+32])))
+    i += 32
+    name_len = struct.unpack('<I', data[i:i+4])[0]
+    i += 4
+    name = struct.unpack('<' + "B"*name_len, data[i:i+name_len])
+    i += name_len
+    symbol_len = struct.unpack('<I', data[i:i+4])[0]
+    i += 4
+    symbol = struct.unpack('<' + "B"*symbol_len, data[i:i+symbol_len])
+    i += symbol_len
+    uri_len = struct.unpack('<I', data[i:i+4])[0]
+    i += 4
+    uri = struct.unpack('<' + "B"*uri_len, data[i:i+uri_len])
+    i += uri_len
+    fee = struct.unpack('<h', data[i:i+2])[0]
+    i += 2
+    has_creator = data[i]
+    i += 1
+    creators = []
+    verified = []
+    share = []
+    if has_creator:
+        creator_len = struct.unpack('<I', data[i:i+4])[0]
+        i += 4
+        for _ in range(creator_len):
+            creator = base58.b58encode(bytes(struct.unpack('<' + "B"*32, data[i:i+32])))
+            creators.append(creator.decode("utf8"))
+            i += 32
+            verified.append(data[i])
+            i += 1
+            share.append(data[i])
+            i += 1
+    primary_sale_happened = bool(data[i])
+    i += 1
+    is_mutable = bool(data[i])
+    metadata = {
+        "update_authority": source_account.decode("utf8"),
+        "mint": mint_account.decode("utf8"),
+        "data": {
+            "name": bytes(name).decode("utf-8").strip("\x00"),
+            "symbol": bytes(symbol).decode("utf-8").strip("\x00"),
+            "uri": bytes(uri).decode("utf-8").strip("\x00"),
+            "seller_fee_basis_points": fee,
+            "creators": creators,
+            "verified": verified,
+            "share": share,
+        },
+        "primary_sale_happened": primary_sale_happened,
+        "is_mutable": is_mutable,
+    }
+    return metadata
+
+
+# find_nfts_of_collection as it was, without the per NFT RPC call
+def legacy_filter_collection_nfts(buffers, collection_candy_machin_ids):
+    nfts_ = list()
+    for buffer in buffers:
+        metadata = legacy_unpack_metadata_account(buffer)
+        creators = metadata['data']['creators']
+        verified = metadata['data']['verified']
+        if not verified or verified[0] != 1:
+            continue
+        if not creators:
+            continue
+        if creators[0] in collection_candy_machin_ids:
+            nfts_.append(metadata)
+    return nfts_
+
+
+def _string(rng: random.Random, max_len: int, padded: bool) -> bytes:
+    # mixes ASCII and multi byte UTF-8, padded to max_len with zeros like the Metaplex programs do
+    text = "".join(rng.choice("abcXYZ #0123456789éßø☃") for _ in range(rng.randint(0, max_len // 4)))
+    raw = text.encode("utf-8")[:max_len]
+    raw = raw.decode("utf-8", "ignore").encode("utf-8")
+    if padded:
+        raw = raw.ljust(max_len, b"\x00")
+    return struct.pack('<I', len(raw)) + raw
+
+
+def generate_account(rng: random.Random, max_creators: int, candy_machine_keys) -> bytes:
+    padded = rng.random() < 0.8
+    data = bytes([4]) + rng.randbytes(32) + rng.randbytes(32)
+    data += _string(rng, 32, padded) + _string(rng, 10, padded) + _string(rng, 200, padded)
+    data += struct.pack('<h', rng.randint(0, 10000))
+    creator_count = rng.randint(0, max_creators)
+    if creator_count == 0 and rng.random() < 0.5:
+        data += bytes([0])
+    else:
+        data += bytes([1]) + struct.pack('<I', creator_count)
+        for index in range(creator_count):
+            creator = rng.choice(candy_machine_keys) if index == 0 and rng.random() < 0.5 else rng.randbytes(32)
+            data += creator + bytes([rng.randint(0, 1), rng.randint(0, 100)])
+    data += bytes([rng.randint(0, 1), rng.randint(0, 1)])
+    # accounts are allocated bigger than their content
+    return data + bytes(rng.randint(0, 64))
+
+
+def check_equivalence(buffers, candy_machine_ids) -> int:
+    mismatches = 0
+    for index, buffer in enumerate(buffers):
+        expected = legacy_unpack_metadata_account(buffer)
+        if nfts.MetadataAccount(buffer).to_dict() != expected or nfts.unpack_metadata_account(buffer) != expected:
+            mismatches += 1
+            print(f"account #{index} decodes differently: {buffer.hex()}")
+    if nfts.filter_collection_nfts(nfts.decode_many(buffers), candy_machine_ids) != \
+            legacy_filter_collection_nfts(buffers, candy_machine_ids):
+        mismatches += 1
+        print("collection filter results differ")
+    return mismatches
+
+
+def timed(function, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=2000)
+    parser.add_argument("--creators", type=int, default=3, help="max creators per account")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    candy_machine_keys = [rng.randbytes(32) for _ in range(3)]
+    candy_machine_ids = [base58.b58encode(key).decode("utf8") for key in candy_machine_keys]
+    buffers = [generate_account(rng, args.creators, candy_machine_keys) for _ in range(args.accounts)]
+
+    mismatches = check_equivalence(buffers, candy_machine_ids)
+    if mismatches:
+        print(f"{mismatches} mismatches between the old and the new decoder")
+        return 1
+    print(f"{len(buffers)} accounts decode to the same dict with both decoders")
+
+    print(f"old unpack -> dict:             {timed(lambda: [legacy_unpack_metadata_account(b) for b in buffers], args.repeat):8.1f} ms")
+    print(f"new unpack -> dict:             {timed(lambda: [nfts.unpack_metadata_account(b) for b in buffers], args.repeat):8.1f} ms")
+    print(f"decode_many (lazy):             {timed(lambda: nfts.decode_many(buffers), args.repeat):8.1f} ms")
+    print(f"old collection filter:          {timed(lambda: legacy_filter_collection_nfts(buffers, candy_machine_ids), args.repeat):8.1f} ms")
+    print(f"new collection filter:          {timed(lambda: nfts.filter_collection_nfts(nfts.decode_many(buffers), candy_machine_ids), args.repeat):8.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
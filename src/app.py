@@ -1,13 +1,26 @@
 #!/usr/bin/env python3
 import os
+import json
+import time
+import queue
+import asyncio
+import threading
 
 import yaml
 import solana.exceptions
-from flask import Flask, request
+from flask import Flask, Response, request
 from dotenv import load_dotenv
 from waitress import serve
 
-from libvistier import api_search_wallet_for_nfts, api_process_signature
+from libvistier import (
+    api_search_wallet_for_nfts,
+    api_search_wallets_for_nfts,
+    api_stream_wallet_for_nfts,
+    api_process_signature,
+    api_process_signatures,
+    refresh_collection_indexes
+)
+from libvistier import metrics
 from libvistier.utils import get_logger
 
 logger = get_logger("VistierAPI")
@@ -15,6 +28,10 @@ logger = get_logger("VistierAPI")
 load_dotenv()
 app = Flask(__name__)
 
+# how many events a stream buffers ahead of a slow client, the scan waits for the client beyond that
+STREAM_BUFFER_SIZE = 64
+_STREAM_END = object()
+
 
 def init_settings():
     cfg_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yaml")
@@ -22,20 +39,39 @@ def init_settings():
         yaml_configs = yaml.safe_load(input_stream)
 
     return {
+        "escrow_engine": yaml_configs['ESCROW_ENGINE'],
         "escrow_tx_workers": yaml_configs['ESCROW_TX_PROCESSING_WORKERS'],
         "escrow_tx_to_process": yaml_configs['ESCROW_TX_TO_PROCESS'],
         "escrow_max_tx_to_process": yaml_configs['ESCROW_MAX_TX_TO_PROCESS'],
+        "escrow_idle_tx_window": yaml_configs['ESCROW_IDLE_TX_WINDOW'],
+        "escrow_time_budget": yaml_configs['ESCROW_TIME_BUDGET_SECONDS'],
 
         "sales_tx_workers": yaml_configs['SALES_TX_PROCESSING_WORKERS'],
         "sales_tx_to_process": yaml_configs['SALES_TX_TO_PROCESS_PER_NFT'],
         "sales_max_tx_to_process": yaml_configs['SALES_NFT_MAX_TX_TO_PROCESS'],
         "sales_max_nft_to_inspect": yaml_configs['SALES_NFT_MAX_TO_INSPECT'],
+
+        "wallet_token_scan": yaml_configs['WALLET_TOKEN_SCAN'],
+        "wallet_batch_concurrency": yaml_configs['WALLET_BATCH_CONCURRENCY'],
+        "signatures_batch_max_size": yaml_configs['SIGNATURES_BATCH_MAX_SIZE'],
+
+        "collection_index_cmids": yaml_configs['COLLECTION_INDEX_CANDY_MACHINE_IDS'] or list(),
+        "collection_index_refresh_seconds": yaml_configs['COLLECTION_INDEX_REFRESH_SECONDS'],
+
+        "rpc_max_concurrency": yaml_configs['RPC_MAX_CONCURRENCY'],
+        "rpc_max_retries": yaml_configs['RPC_MAX_RETRIES'],
     }
 
 
 settings = init_settings()
 
 
+def refresh_collection_indexes_periodically():
+    while True:
+        refresh_collection_indexes(settings['collection_index_cmids'])
+        time.sleep(settings['collection_index_refresh_seconds'])
+
+
 @app.route('/wallet-status', methods=['GET'])
 async def wallet_status():
     response = {
@@ -45,6 +81,7 @@ async def wallet_status():
 
     contract_address = request.args.get('address')
     candy_machine_ids = request.args.getlist('cmid')
+    trace_token = metrics.start_trace() if request.args.get('trace') else None
 
     try:
         response['status'] = "ok"
@@ -62,9 +99,102 @@ async def wallet_status():
         response['status'] = "error"
         response['content'] = "Unexpected internal error"
         status_code = 500
-        logger.exception(f"Error while parsing contract address: {contract_address} and with cmids: {candy_machine_ids}")
+        logger.exception("Error while parsing contract address: %s and with cmids: %s", contract_address, candy_machine_ids)
+
+    if trace_token is not None:
+        response['trace'] = metrics.stop_trace(trace_token)
 
-    logger.info(f"response: {response}")
+    logger.info("response status: %s", response['status'])
+    logger.debug("response: %s", response)
+    return response, status_code, {'Content-Type': 'application/json; charset=utf-8'}
+
+
+def stream_ndjson(events_factory, error_context: str):
+    """
+    Runs the async generator returned by events_factory() on its own event loop, in a thread, and returns a
+    generator of its events as NDJSON lines for a streamed response. If the client goes away, the async generator is
+    closed (stopping its scans) the next time it yields.
+    """
+    lines = queue.Queue(maxsize=STREAM_BUFFER_SIZE)
+    closed = threading.Event()
+
+    def offer(line) -> bool:
+        while not closed.is_set():
+            try:
+                lines.put(line, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def produce():
+        events = events_factory()
+        try:
+            async for event in events:
+                if not offer(json.dumps(event) + "\n"):
+                    break
+        except solana.exceptions.SolanaRpcException:
+            offer(json.dumps({"event": "error",
+                              "content": "Client error '429 Too Many Requests' for endpoint url"}) + "\n")
+        except Exception:
+            logger.exception("Error while streaming %s", error_context)
+            offer(json.dumps({"event": "error", "content": "Unexpected internal error"}) + "\n")
+        finally:
+            await events.aclose()
+            offer(_STREAM_END)
+
+    def consume():
+        try:
+            while True:
+                line = lines.get()
+                if line is _STREAM_END:
+                    return
+                yield line
+        finally:
+            closed.set()
+
+    threading.Thread(target=asyncio.run, args=(produce(),), daemon=True).start()
+    return consume()
+
+
+@app.route('/wallet-status/stream', methods=['GET'])
+def wallet_status_stream():
+    """
+    Same parameters as /wallet-status. Streams the api_stream_wallet_for_nfts events as NDJSON, one per line.
+    """
+    contract_address = request.args.get('address')
+    candy_machine_ids = request.args.getlist('cmid')
+
+    lines = stream_ndjson(lambda: api_stream_wallet_for_nfts(settings, contract_address, candy_machine_ids),
+                          f"contract address: {contract_address} and with cmids: {candy_machine_ids}")
+    return Response(lines, status=200, mimetype='application/x-ndjson')
+
+
+@app.route('/wallet-status/batch', methods=['POST'])
+async def wallet_status_batch():
+    """
+    Expects a JSON body: {"addresses": [<wallet address>, ...], "cmids": [<candy machine id>, ...]}
+    """
+    response = {
+        "status": "ok",
+        "content": dict()
+    }
+
+    payload = request.get_json(silent=True) or dict()
+    wallet_addresses = payload.get('addresses', list())
+    candy_machine_ids = payload.get('cmids', list())
+
+    try:
+        response['status'] = "ok"
+        response['content'] = await api_search_wallets_for_nfts(settings, wallet_addresses, candy_machine_ids)
+        status_code = 200
+    except Exception:
+        response['status'] = "error"
+        response['content'] = "Unexpected internal error"
+        status_code = 500
+        logger.exception("Error while processing %d wallets with cmids: %s", len(wallet_addresses), candy_machine_ids)
+
+    logger.info("batch response status: %s", response['status'])
     return response, status_code, {'Content-Type': 'application/json; charset=utf-8'}
 
 
@@ -81,11 +211,57 @@ async def marketplace_signature(signature):
     except Exception:
         response['status'] = "error"
         response['content'] = "Unexpected internal error"
-        logger.exception(f"Error while parsing signature {signature}")
+        logger.exception("Error while parsing signature %s", signature)
         status_code = 500
 
     return response, status_code, {'Content-Type': 'application/json; charset=utf-8'}
 
+
+@app.route('/marketplace-signatures', methods=['POST'])
+async def marketplace_signatures():
+    """
+    Expects a JSON body: {"signatures": [<signature hash>, ...]}
+    """
+    response = {
+        "status": "ok",
+        "content": list()
+    }
+
+    payload = request.get_json(silent=True)
+    signatures = payload.get('signatures') if isinstance(payload, dict) else None
+    if not isinstance(signatures, list) or not all(isinstance(signature, str) for signature in signatures):
+        response['status'] = "error"
+        response['content'] = "Expected a JSON body with a list of signature strings: {\"signatures\": [...]}"
+        return response, 400, {'Content-Type': 'application/json; charset=utf-8'}
+    if len(signatures) > settings['signatures_batch_max_size']:
+        response['status'] = "error"
+        response['content'] = f"At most {settings['signatures_batch_max_size']} signatures can be sent at once"
+        return response, 413, {'Content-Type': 'application/json; charset=utf-8'}
+
+    try:
+        response['status'] = "ok"
+        response['content'] = await api_process_signatures(settings, signatures)
+        status_code = 200
+    except Exception:
+        response['status'] = "error"
+        response['content'] = "Unexpected internal error"
+        logger.exception("Error while parsing %d signatures", len(signatures))
+        status_code = 500
+
+    return response, status_code, {'Content-Type': 'application/json; charset=utf-8'}
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus scrape endpoint, only served when VISTIER_METRICS is set.
+    """
+    if not metrics.is_enabled():
+        return "metrics are disabled", 404, {'Content-Type': 'text/plain; charset=utf-8'}
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 if __name__ == '__main__':
+    if settings['collection_index_cmids']:
+        threading.Thread(target=refresh_collection_indexes_periodically, daemon=True).start()
     port = int(os.environ.get('PORT', 5000))
     serve(app, host='0.0.0.0', port=port)
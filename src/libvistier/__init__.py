@@ -1,4 +1,9 @@
 from .entrypoint import (
     api_search_wallet_for_nfts,
-    api_process_signature
+    api_search_wallets_for_nfts,
+    api_stream_wallet_for_nfts,
+    api_process_signature,
+    api_process_signatures,
+    refresh_collection_indexes
 )
+from .transactions import transaction_cache_stats
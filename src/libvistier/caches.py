@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+from typing import Dict, Iterable, Optional, Tuple
+from collections import OrderedDict
+
+from . import metrics
+from .utils import chunks
+
+# directory where persistent caches are stored. If not set, caches are kept in memory only
+CACHE_DIR_ENV = 'VISTIER_CACHE_DIR'
+
+# SQLite limits the number of host parameters in a single statement, stay well below it
+SQLITE_PARAMETERS_CHUNK_SIZE = 500
+
+
+def get_cache_path(file_name: str) -> Optional[str]:
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, file_name)
+
+
+def open_database(path: str) -> sqlite3.Connection:
+    """
+    Opens a SQLite database that can be shared by threads (calls must be serialized by the caller)
+    and by processes (WAL journal, busy timeout).
+    """
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+def record_lookups(cache: str, hits: int, lookups: int) -> None:
+    metrics.increment("vistier_cache_requests_total", hits, cache=cache, result="hit")
+    metrics.increment("vistier_cache_requests_total", lookups - hits, cache=cache, result="miss")
+
+
+class LRUCache:
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class PdaCache:
+    """
+    mint -> metadata PDA cache. Derivations never change so entries are never invalidated.
+    An in-process LRU sits in front of an optional SQLite table shared by all workers of a deployment.
+    """
+
+    def __init__(self, max_size: int, path: Optional[str] = None) -> None:
+        self._memory = LRUCache(max_size)
+        self._lock = threading.Lock()
+        self._database = None
+        if path:
+            self._database = open_database(path)
+            self._database.execute("CREATE TABLE IF NOT EXISTS pdas (mint TEXT PRIMARY KEY, pda BLOB NOT NULL)")
+
+    def get_many(self, mints: Iterable[str]) -> Dict[str, bytes]:
+        found = dict()
+        not_in_memory = list()
+        for mint in mints:
+            pda = self._memory.get(mint)
+            if pda is None:
+                not_in_memory.append(mint)
+            else:
+                found[mint] = pda
+        lookups = len(found) + len(not_in_memory)
+
+        if self._database is None or not not_in_memory:
+            record_lookups("pdas", len(found), lookups)
+            return found
+
+        with self._lock:
+            for mint_chunk in chunks(not_in_memory, SQLITE_PARAMETERS_CHUNK_SIZE):
+                rows = self._database.execute(
+                    f"SELECT mint, pda FROM pdas WHERE mint IN ({','.join('?' * len(mint_chunk))})", mint_chunk
+                ).fetchall()
+                for mint, pda in rows:
+                    found[mint] = pda
+                    self._memory.put(mint, pda)
+        record_lookups("pdas", len(found), lookups)
+        return found
+
+    def put_many(self, pdas: Dict[str, bytes]) -> None:
+        for mint, pda in pdas.items():
+            self._memory.put(mint, pda)
+
+        if self._database is None or not pdas:
+            return
+
+        with self._lock:
+            self._database.execute("BEGIN")
+            self._database.executemany("INSERT OR IGNORE INTO pdas (mint, pda) VALUES (?, ?)", pdas.items())
+            self._database.execute("COMMIT")
+
+
+class TransactionCache:
+    """
+    signature -> raw getTransaction response store. Finalized transactions never change, so entries are only ever
+    removed to keep the store under max_bytes (least recently used first). Responses are kept zlib compressed.
+    With a path, the store is shared between threads and processes; without one it lives in memory.
+    """
+
+    # fraction of max_bytes to evict down to, so that eviction does not run on every insert
+    EVICTION_TARGET = 0.9
+    # hits are remembered and their last access time written in a single transaction once this many piled up
+    ACCESS_FLUSH_SIZE = 256
+
+    def __init__(self, max_bytes: int, path: Optional[str] = None) -> None:
+        self.max_bytes = max_bytes
+        # a store on disk can be slow, callers on an event loop should use it from an executor
+        self.persistent = path is not None
+        self._lock = threading.Lock()
+        # signature -> last access time not written yet
+        self._accessed = dict()
+        self._database = open_database(path or ":memory:")
+        self._database.execute("CREATE TABLE IF NOT EXISTS transactions ("
+                               "signature TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                               "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self._database.execute("CREATE INDEX IF NOT EXISTS transactions_last_access "
+                               "ON transactions (last_access)")
+        self._stored_bytes = self._database.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM transactions").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, signature: str) -> Optional[str]:
+        with self._lock:
+            row = self._database.execute("SELECT data FROM transactions WHERE signature = ?",
+                                         (signature,)).fetchone()
+            if row is None:
+                self.misses += 1
+                record_lookups("transactions", 0, 1)
+                return None
+            self._accessed[signature] = time.time()
+            if len(self._accessed) >= self.ACCESS_FLUSH_SIZE:
+                self._flush_accesses()
+            raw = zlib.decompress(row[0]).decode("utf8")
+            self.hits += 1
+            self.bytes_saved += len(raw)
+            record_lookups("transactions", 1, 1)
+            return raw
+
+    def put(self, signature: str, raw: str) -> None:
+        data = zlib.compress(raw.encode("utf8"))
+        with self._lock:
+            self._database.execute("INSERT OR REPLACE INTO transactions (signature, data, size, last_access) "
+                                   "VALUES (?, ?, ?, ?)", (signature, data, len(data), time.time()))
+            self._stored_bytes += len(data)
+            if self._stored_bytes > self.max_bytes:
+                self._evict()
+
+    def _flush_accesses(self) -> None:
+        accessed, self._accessed = self._accessed, dict()
+        self._database.execute("BEGIN")
+        self._database.executemany("UPDATE transactions SET last_access = ? WHERE signature = ?",
+                                   [(last_access, signature) for signature, last_access in accessed.items()])
+        self._database.execute("COMMIT")
+
+    def _evict(self) -> None:
+        # the eviction order must see the latest hits
+        if self._accessed:
+            self._flush_accesses()
+        # other processes may have written to the store as well, recount before evicting
+        self._stored_bytes = self._database.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM transactions").fetchone()[0]
+        to_free = self._stored_bytes - int(self.max_bytes * self.EVICTION_TARGET)
+        if to_free <= 0:
+            return
+
+        evicted = list()
+        freed = 0
+        for signature, size in self._database.execute(
+                "SELECT signature, size FROM transactions ORDER BY last_access"):
+            if freed >= to_free:
+                break
+            evicted.append((signature,))
+            freed += size
+
+        self._database.execute("BEGIN")
+        self._database.executemany("DELETE FROM transactions WHERE signature = ?", evicted)
+        self._database.execute("COMMIT")
+        self._stored_bytes -= freed
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "bytes_saved": self.bytes_saved,
+            "stored_bytes": self._stored_bytes,
+        }
+
+
+class LastSaleIndex:
+    """
+    mint -> last known sale index. Each entry holds the newest signature that was checked for the mint and the sale
+    found at that point (the to_dict() of the sale transaction, or None if no sale was found). Repeated queries only
+    need to look at signatures newer than the checkpoint.
+    With a path, the index is shared between threads and processes; without one it lives in memory.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._lock = threading.Lock()
+        self._database = open_database(path or ":memory:")
+        self._database.execute("CREATE TABLE IF NOT EXISTS last_sales ("
+                               "mint TEXT PRIMARY KEY, newest_signature TEXT NOT NULL, sale TEXT, "
+                               "updated REAL NOT NULL)")
+
+    def get(self, mint: str) -> Optional[Tuple[str, Optional[dict]]]:
+        with self._lock:
+            row = self._database.execute("SELECT newest_signature, sale FROM last_sales WHERE mint = ?",
+                                         (mint,)).fetchone()
+        record_lookups("last_sales", row is not None, 1)
+        if row is None:
+            return None
+        newest_signature, sale = row
+        return newest_signature, json.loads(sale) if sale else None
+
+    def put(self, mint: str, newest_signature: str, sale: Optional[dict]) -> None:
+        with self._lock:
+            self._database.execute("INSERT OR REPLACE INTO last_sales (mint, newest_signature, sale, updated) "
+                                   "VALUES (?, ?, ?, ?)",
+                                   (mint, newest_signature, json.dumps(sale) if sale else None, time.time()))
@@ -1,20 +1,658 @@
 import os
+import json
+import time
+import atexit
+import itertools
+import random
+import asyncio
+import threading
 
+from collections import deque
+from typing import List, Optional, Tuple
+
+import httpx
+from solana.exceptions import SolanaRpcException
 from solana.rpc.api import Client
 from solana.rpc.async_api import AsyncClient
+from solana.rpc.core import RPCException
+from solana.rpc.providers.async_http import AsyncHTTPProvider
+from solana.rpc.providers.base import BaseProvider
+from solana.rpc.providers.async_base import AsyncBaseProvider
+from solders.rpc.requests import (
+    GetTransaction,
+    GetSignaturesForAddress,
+    GetAccountInfo,
+    GetMultipleAccounts,
+    GetProgramAccounts,
+    GetTokenAccountsByOwner
+)
+from solders.rpc.responses import RPCError, batch_from_json
+
+from . import metrics
+from .scheduler import AdaptiveScheduler, is_retryable, record_rpc_latency
+from .utils import get_logger
+
+logger = get_logger("VistierAPI")
+
+# comma separated list of RPC endpoints as <url>[|<weight>[|<max requests per second>]], for example
+# "https://a.rpc.com|3|50,https://b.rpc.com|1". If not set, SOLANA_RPC_ENDPOINT is used as the single endpoint
+ENDPOINTS_ENV = 'SOLANA_RPC_ENDPOINTS'
+
+# maximum number of (keep-alive) connections opened to each RPC endpoint, shared by all clients of the process
+POOL_SIZE_ENV = 'SOLANA_RPC_POOL_SIZE'
+DEFAULT_POOL_SIZE = 32
+
+# seconds between two health checks of the RPC endpoints
+HEALTH_CHECK_INTERVAL_ENV = 'SOLANA_RPC_HEALTH_CHECK_INTERVAL'
+DEFAULT_HEALTH_CHECK_INTERVAL = 60
+
+# seconds after which an RPC request is abandoned
+REQUEST_TIMEOUT_ENV = 'SOLANA_RPC_TIMEOUT'
+DEFAULT_REQUEST_TIMEOUT = 10
+
+# how many requests to pack, at most, in a single JSON-RPC batch POST. 1 disables batching
+BATCH_SIZE_ENV = 'SOLANA_RPC_BATCH_SIZE'
+DEFAULT_BATCH_SIZE = 25
+
+# milliseconds to wait for more requests before sending an incomplete batch
+BATCH_LINGER_MS_ENV = 'SOLANA_RPC_BATCH_LINGER_MS'
+DEFAULT_BATCH_LINGER_MS = 5
+
+# latency percentile of an endpoint after which a read only request is also sent to a second endpoint.
+# 0 disables hedging
+HEDGE_PERCENTILE_ENV = 'SOLANA_RPC_HEDGE_PERCENTILE'
+DEFAULT_HEDGE_PERCENTILE = 95
+
+# read only requests issued in bulk by the escrow and sales scanners, these are sent in JSON-RPC batches
+BATCHED_REQUESTS = (GetTransaction, GetSignaturesForAddress)
+
+# requests that can safely be sent to two endpoints at once
+HEDGED_REQUESTS = (GetTransaction, GetSignaturesForAddress, GetAccountInfo, GetMultipleAccounts,
+                   GetProgramAccounts, GetTokenAccountsByOwner)
+
+
+def parse_endpoints(value: str) -> List[Tuple[str, float, float]]:
+    endpoints = list()
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        parts = item.strip().split("|")
+        weight = float(parts[1]) if len(parts) > 1 else 1.0
+        rate_limit = float(parts[2]) if len(parts) > 2 else 0.0
+        endpoints.append((parts[0], weight, rate_limit))
+    return endpoints
+
+
+class RpcBatcher:
+    """
+    Packs individual requests into JSON-RPC batch POSTs and fans the results back out to the awaiting callers.
+    A batch is sent as soon as batch_size requests are queued or linger seconds after its first request.
+    Each request of a batch gets its own id and results are matched by id, as a batch may be answered in any order.
+    If the endpoint rejects batches, requests are sent one by one from then on.
+    Must only be used from the loop it was created for.
+    """
+
+    def __init__(self, router: "RpcRouter", batch_size: int, linger: float) -> None:
+        self.router = router
+        self.batch_size = batch_size
+        self.linger = linger
+        self.enabled = True
+        self._pending = list()
+        self._flush_handle = None
+        self._ids = itertools.count(1)
+        # batches being sent, kept referenced until they are done
+        self._sending = set()
+
+    async def make_request(self, body, parser):
+        if not self.enabled:
+            return await self.router.make_request(body, parser)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((body, parser, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.linger, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, list()
+        batch = [request for request in batch if not request[2].done()]
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._send_batch(batch))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+        # once every caller of the batch gave up on it (e.g. a scan that stopped early), there is no point sending it
+        futures = [future for _, _, future in batch]
+        for future in futures:
+            future.add_done_callback(lambda _: task.cancel() if all(f.cancelled() for f in futures) else None)
+
+    async def _send_batch(self, batch) -> None:
+        try:
+            await self._send(batch)
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            # the callers are waiting on their futures, any failure must reach them
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for _, _, future in self._pending:
+            future.cancel()
+        self._pending = list()
+        for task in self._sending:
+            task.cancel()
+        await asyncio.gather(*self._sending, return_exceptions=True)
+
+    @staticmethod
+    def _with_id(body, request_id: int):
+        # solders requests are immutable, the id is set through their JSON form
+        request = json.loads(body.to_json())
+        request["id"] = request_id
+        return type(body).from_json(json.dumps(request))
+
+    async def _send_single(self, body, parser, future) -> None:
+        try:
+            result = await self.router.make_request(body, parser)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    def _disable(self, reason) -> None:
+        if self.enabled:
+            logger.warning("RPC endpoint rejected a JSON-RPC batch (%s), sending requests one by one", reason)
+        self.enabled = False
+
+    async def _send(self, batch) -> None:
+        if len(batch) == 1 or not self.enabled:
+            await asyncio.gather(*[self._send_single(body, parser, future) for body, parser, future in batch])
+            return
+
+        ids = [next(self._ids) for _ in batch]
+        try:
+            raw = await self.router.make_batch_request_unparsed(
+                tuple(self._with_id(body, request_id) for (body, _, _), request_id in zip(batch, ids)))
+            responses = json.loads(raw)
+        except Exception as e:
+            if isinstance(e, httpx.HTTPStatusError) and not is_retryable(e):
+                self._disable(e.response.status_code)
+                await self._send(batch)
+                return
+            if isinstance(e, httpx.HTTPError):
+                http_error = e
+                e = SolanaRpcException(http_error, self._send, self, batch[0][0])
+                e.__cause__ = http_error
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if not isinstance(responses, list):
+            # a single error object instead of one response per request
+            self._disable(responses.get("error") if isinstance(responses, dict) else responses)
+            await self._send(batch)
+            return
+
+        responses_by_id = {response.get("id"): response for response in responses if isinstance(response, dict)}
+        answered = [(request, responses_by_id[request_id])
+                    for request, request_id in zip(batch, ids) if request_id in responses_by_id]
+        results = batch_from_json(json.dumps([response for _, response in answered]),
+                                  [parser for (_, parser, _), _ in answered]) if answered else []
+        for ((_, _, future), _), result in zip(answered, results):
+            if future.done():
+                continue
+            if isinstance(result, RPCError.__args__):
+                future.set_exception(RPCException(result))
+            else:
+                future.set_result(result)
+
+        for (body, _, future), request_id in zip(batch, ids):
+            if not future.done() and request_id not in responses_by_id:
+                future.set_exception(Exception(f"RPC batch response has no result for request {request_id} "
+                                               f"({type(body).__name__})"))
+
+
+class RpcEndpoint:
+    """
+    One RPC endpoint of the pool, with its own keep-alive connections, request budget (token bucket) and
+    health score built from recent successes and latencies.
+    """
+
+    # how many recent latencies are kept for the hedging percentile
+    LATENCY_SAMPLES = 200
+    # hedging starts only once the latency percentile is meaningful
+    MIN_HEDGE_SAMPLES = 20
+    # smoothing of the success rate and latency averages
+    EWMA_WEIGHT = 0.1
+
+    def __init__(self, url: str, weight: float, rate_limit: float, pool_size: int, timeout: float) -> None:
+        self.url = url
+        self.weight = weight
+        self.rate_limit = rate_limit
+        self.healthy = True
+
+        self.provider = AsyncHTTPProvider(url, timeout=timeout)
+        self.provider.session = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+        self.success_rate = 1.0
+        self.avg_latency = None
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self._tokens = rate_limit
+        self._last_refill = time.monotonic()
+
+        self.requests = 0
+        self.failures = 0
+
+    def __str__(self) -> str:
+        return self.url
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.rate_limit, self._tokens + (now - self._last_refill) * self.rate_limit)
+        self._last_refill = now
+
+    def has_budget(self) -> bool:
+        if not self.rate_limit:
+            return True
+        self._refill()
+        return self._tokens >= 1
+
+    def time_to_budget(self) -> float:
+        if self.has_budget():
+            return 0
+        return (1 - self._tokens) / self.rate_limit
+
+    def take_budget(self, cost: int) -> None:
+        # a batch may take the bucket below zero, the debt is paid by waiting before the next request
+        if self.rate_limit:
+            self._tokens -= cost
+
+    def record_success(self, latency: float) -> None:
+        self.requests += 1
+        self._latencies.append(latency)
+        self.success_rate += self.EWMA_WEIGHT * (1 - self.success_rate)
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        self.avg_latency += self.EWMA_WEIGHT * (latency - self.avg_latency)
+
+    def record_failure(self) -> None:
+        self.requests += 1
+        self.failures += 1
+        self.success_rate -= self.EWMA_WEIGHT * self.success_rate
+
+    def score(self, best_latency: Optional[float]) -> float:
+        if not self.healthy:
+            return 0
+        latency_factor = 1.0
+        if best_latency and self.avg_latency:
+            latency_factor = best_latency / self.avg_latency
+        # never drop to 0, so that a recovered endpoint gets traffic (and a chance to prove itself) again
+        return self.weight * max(self.success_rate * latency_factor, 0.01)
+
+    def hedge_delay(self, percentile: float) -> Optional[float]:
+        if not percentile or len(self._latencies) < self.MIN_HEDGE_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+class RpcRouter:
+    """
+    Routes requests over the configured endpoints: picks endpoints by weight and health score, keeps each under its
+    request budget, fails over to another endpoint when one throttles or errors and hedges read only requests,
+    i.e. if an endpoint is slower than its usual (percentile) latency the request is also sent to a second endpoint
+    and whichever answers first wins.
+    """
+
+    def __init__(self, endpoints: List[RpcEndpoint], hedge_percentile: float) -> None:
+        self.endpoints = endpoints
+        self.hedge_percentile = hedge_percentile
+        self.hedged = 0
+        self.failovers = 0
+
+    def _candidates(self, excluded) -> List[RpcEndpoint]:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in excluded]
+        # if every endpoint is marked unhealthy, still try them rather than failing outright
+        return [endpoint for endpoint in candidates if endpoint.healthy] or candidates
+
+    def _pick(self, candidates: List[RpcEndpoint]) -> RpcEndpoint:
+        latencies = [endpoint.avg_latency for endpoint in self.endpoints if endpoint.avg_latency]
+        best_latency = min(latencies) if latencies else None
+        return random.choices(candidates, weights=[endpoint.score(best_latency) for endpoint in candidates])[0]
+
+    def choose_now(self, excluded, cost: int) -> Optional[RpcEndpoint]:
+        candidates = [endpoint for endpoint in self._candidates(excluded) if endpoint.has_budget()]
+        if not candidates:
+            return None
+        endpoint = self._pick(candidates)
+        endpoint.take_budget(cost)
+        return endpoint
+
+    async def choose(self, excluded, cost: int) -> Optional[RpcEndpoint]:
+        while True:
+            candidates = self._candidates(excluded)
+            if not candidates:
+                return None
+            endpoint = self.choose_now(excluded, cost)
+            if endpoint is not None:
+                return endpoint
+            # every endpoint spent its budget, wait for the first one to refill
+            await asyncio.sleep(min(candidate.time_to_budget() for candidate in candidates))
+
+    @staticmethod
+    async def _timed(endpoint: RpcEndpoint, send):
+        started = time.monotonic()
+        try:
+            result = await send(endpoint)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if is_retryable(e):
+                endpoint.record_failure()
+            raise
+        endpoint.record_success(time.monotonic() - started)
+        return result
+
+    async def _hedged(self, primary: RpcEndpoint, send, excluded, cost: int):
+        primary_task = asyncio.ensure_future(self._timed(primary, send))
+        delay = primary.hedge_delay(self.hedge_percentile)
+        if delay is None:
+            return await primary_task
+
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+        if done:
+            return primary_task.result()
+
+        backup = self.choose_now(excluded, cost)
+        if backup is None:
+            return await primary_task
+        excluded.add(backup)
+        self.hedged += 1
+
+        pending = {primary_task, asyncio.ensure_future(self._timed(backup, send))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _dispatch(self, send, cost: int, hedge: bool):
+        excluded = set()
+        while True:
+            endpoint = await self.choose(excluded, cost)
+            if endpoint is None:
+                raise Exception("No RPC endpoint left to send the request to")
+            excluded.add(endpoint)
+            try:
+                if hedge and len(self.endpoints) > 1:
+                    return await self._hedged(endpoint, send, excluded, cost)
+                return await self._timed(endpoint, send)
+            except Exception as e:
+                if not is_retryable(e) or len(excluded) >= len(self.endpoints):
+                    raise
+                self.failovers += 1
+                logger.warning("RPC endpoint %s failed, failing over to another endpoint", endpoint)
+
+    async def make_request(self, body, parser):
+        return await self._dispatch(lambda endpoint: endpoint.provider.make_request(body, parser),
+                                    cost=1, hedge=isinstance(body, HEDGED_REQUESTS))
+
+    async def make_batch_request(self, reqs, parsers):
+        return await self._dispatch(lambda endpoint: endpoint.provider.make_batch_request(reqs, parsers),
+                                    cost=len(reqs), hedge=all(isinstance(body, HEDGED_REQUESTS) for body in reqs))
+
+    async def make_batch_request_unparsed(self, reqs):
+        return await self._dispatch(lambda endpoint: endpoint.provider.make_batch_request_unparsed(reqs),
+                                    cost=len(reqs), hedge=all(isinstance(body, HEDGED_REQUESTS) for body in reqs))
+
+    async def check_health(self) -> bool:
+        results = await asyncio.gather(*[endpoint.provider.is_connected() for endpoint in self.endpoints])
+        for endpoint, healthy in zip(self.endpoints, results):
+            if endpoint.healthy and not healthy:
+                logger.warning("RPC endpoint %s failed its health check", endpoint)
+            endpoint.healthy = healthy
+        return any(results)
+
+    async def close(self) -> None:
+        await asyncio.gather(*[endpoint.provider.close() for endpoint in self.endpoints])
+
+    def stats(self) -> dict:
+        return {
+            "hedged": self.hedged,
+            "failovers": self.failovers,
+            "endpoints": {
+                endpoint.url: {
+                    "healthy": endpoint.healthy,
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures,
+                    "success_rate": endpoint.success_rate,
+                    "avg_latency": endpoint.avg_latency
+                }
+                for endpoint in self.endpoints
+            }
+        }
+
+
+class RpcConnectionPool:
+    """
+    Owns the keep-alive connection pools to the RPC endpoints. The pool runs on a dedicated event loop thread
+    so that it can be shared by sync callers and by async callers running on any event loop (waitress threads each
+    run their own). Clients returned by get_client and get_async_client only forward their requests to it.
+    """
+
+    def __init__(self, endpoints: List[Tuple[str, float, float]], pool_size: int, health_check_interval: float,
+                 timeout: float, batch_size: int = DEFAULT_BATCH_SIZE,
+                 batch_linger: float = DEFAULT_BATCH_LINGER_MS / 1000,
+                 hedge_percentile: float = DEFAULT_HEDGE_PERCENTILE) -> None:
+        self.endpoint = endpoints[0][0]
+        self.health_check_interval = health_check_interval
+        self.healthy = False
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="vistier-rpc-pool", daemon=True)
+        self._thread.start()
+
+        self.router = RpcRouter([RpcEndpoint(url, weight, rate_limit, pool_size, timeout)
+                                 for url, weight, rate_limit in endpoints], hedge_percentile)
+        self.batcher = RpcBatcher(self.router, batch_size, batch_linger) if batch_size > 1 else None
+
+        if not self.submit(self.check_health()).result():
+            self.close()
+            raise Exception(f"Could not connect to mainnet RPC endpoint(s): {[url for url, _, _ in endpoints]}!")
+        self._health_task = self.submit(self._periodic_health_check())
+
+    def submit(self, coroutine):
+        """Schedules the coroutine on the pool loop, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def make_request(self, body, parser):
+        if self.batcher is not None and isinstance(body, BATCHED_REQUESTS):
+            return await self.batcher.make_request(body, parser)
+        return await self.router.make_request(body, parser)
+
+    async def make_batch_request(self, reqs, parsers):
+        return await self.router.make_batch_request(reqs, parsers)
+
+    async def check_health(self) -> bool:
+        self.healthy = await self.router.check_health()
+        return self.healthy
+
+    async def _periodic_health_check(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_health()
+
+    def close(self) -> None:
+        if not self.loop.is_running():
+            return
+        if getattr(self, "_health_task", None):
+            self._health_task.cancel()
+        if self.batcher is not None:
+            self.submit(self.batcher.close()).result()
+        self.submit(self.router.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+def _record_request(method: str, started: float, outcome: str) -> None:
+    latency = time.perf_counter() - started
+    metrics.increment("vistier_rpc_requests_total", method=method, outcome=outcome)
+    metrics.observe("vistier_rpc_seconds", latency, method=method)
+    if outcome == "ok":
+        record_rpc_latency(latency)
+
+
+class _PooledProvider(BaseProvider):
+
+    def __init__(self, pool: RpcConnectionPool) -> None:
+        self._pool = pool
+
+    def __str__(self) -> str:
+        return f"Pooled HTTP RPC connection {self._pool.endpoint}"
+
+    def make_request(self, body, parser):
+        started = time.perf_counter()
+        try:
+            result = self._pool.submit(self._pool.make_request(body, parser)).result()
+        except Exception:
+            _record_request(type(body).__name__, started, "error")
+            raise
+        _record_request(type(body).__name__, started, "ok")
+        return result
+
+    def make_batch_request(self, reqs, parsers):
+        started = time.perf_counter()
+        try:
+            result = self._pool.submit(self._pool.make_batch_request(reqs, parsers)).result()
+        except Exception:
+            _record_request("batch", started, "error")
+            raise
+        _record_request("batch", started, "ok")
+        return result
+
+    def is_connected(self) -> bool:
+        return self._pool.healthy
+
+
+class _AsyncPooledProvider(AsyncBaseProvider):
+
+    def __init__(self, pool: RpcConnectionPool) -> None:
+        self._pool = pool
+
+    def __str__(self) -> str:
+        return f"Pooled async HTTP RPC connection {self._pool.endpoint}"
+
+    async def make_request(self, body, parser):
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wrap_future(self._pool.submit(self._pool.make_request(body, parser)))
+        except Exception:
+            _record_request(type(body).__name__, started, "error")
+            raise
+        _record_request(type(body).__name__, started, "ok")
+        return result
+
+    async def make_batch_request(self, reqs, parsers):
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wrap_future(self._pool.submit(self._pool.make_batch_request(reqs, parsers)))
+        except Exception:
+            _record_request("batch", started, "error")
+            raise
+        _record_request("batch", started, "ok")
+        return result
+
+    async def is_connected(self) -> bool:
+        return self._pool.healthy
+
+    async def close(self) -> None:
+        # connections belong to the shared pool, they are closed by close_clients
+        return
+
+
+_pool = None
+_client = None
+_async_client = None
+_scheduler = None
+_lock = threading.Lock()
+
+
+def get_pool() -> RpcConnectionPool:
+    global _pool
+    with _lock:
+        if _pool is None:
+            endpoints = os.environ.get(ENDPOINTS_ENV) or os.environ['SOLANA_RPC_ENDPOINT']
+            _pool = RpcConnectionPool(
+                endpoints=parse_endpoints(endpoints),
+                pool_size=int(os.environ.get(POOL_SIZE_ENV, DEFAULT_POOL_SIZE)),
+                health_check_interval=float(os.environ.get(HEALTH_CHECK_INTERVAL_ENV, DEFAULT_HEALTH_CHECK_INTERVAL)),
+                timeout=float(os.environ.get(REQUEST_TIMEOUT_ENV, DEFAULT_REQUEST_TIMEOUT)),
+                batch_size=int(os.environ.get(BATCH_SIZE_ENV, DEFAULT_BATCH_SIZE)),
+                batch_linger=float(os.environ.get(BATCH_LINGER_MS_ENV, DEFAULT_BATCH_LINGER_MS)) / 1000,
+                hedge_percentile=float(os.environ.get(HEDGE_PERCENTILE_ENV, DEFAULT_HEDGE_PERCENTILE))
+            )
+            atexit.register(close_clients)
+        return _pool
+
+
+def get_scheduler(initial_limit: int, max_limit: int, max_retries: int) -> AdaptiveScheduler:
+    """
+    The scheduler shared by all requests of the process, so that their RPC calls back off together and the endpoints
+    see at most max_limit of them in flight. Created with the limits of the first caller.
+    """
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = AdaptiveScheduler(initial_limit=initial_limit, max_limit=max_limit, max_retries=max_retries)
+        return _scheduler
+
+
+def get_client() -> Client:
+    global _client
+    pool = get_pool()
+    if _client is None:
+        solana_client = Client(endpoint=pool.endpoint)
+        solana_client._provider = _PooledProvider(pool)
+        _client = solana_client
+    return _client
 
 
-def get_client():
-    endpoint = os.environ['SOLANA_RPC_ENDPOINT']
-    solana_client = Client(endpoint=endpoint)
-    if not solana_client.is_connected():
-        raise Exception(f"Could not connect to mainnet RPC endpoint: {endpoint}!")
-    return solana_client
+async def get_async_client() -> AsyncClient:
+    global _async_client
+    pool = get_pool()
+    if _async_client is None:
+        solana_client = AsyncClient(endpoint=pool.endpoint)
+        solana_client._provider = _AsyncPooledProvider(pool)
+        _async_client = solana_client
+    return _async_client
 
 
-async def get_async_client():
-    endpoint = os.environ['SOLANA_RPC_ENDPOINT']
-    solana_client = AsyncClient(endpoint=endpoint)
-    if not await solana_client.is_connected():
-        raise Exception(f"Could not connect to mainnet RPC endpoint: {endpoint}!")
-    return solana_client
+def close_clients() -> None:
+    global _pool, _client, _async_client, _scheduler
+    with _lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = _client = _async_client = _scheduler = None
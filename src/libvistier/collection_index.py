@@ -0,0 +1,152 @@
+import os
+import mmap
+import struct
+import threading
+
+from typing import Dict, List, Optional, Tuple
+
+from solders.pubkey import Pubkey
+
+from .caches import get_cache_path
+
+COLLECTION_INDEX_DIR = "collections"
+
+# one record per collection mint, sorted by mint: mint (32), name (32, zero padded), seller fee basis points (u16)
+_RECORD = struct.Struct('<32s32sH')
+_MINT_SIZE = 32
+
+
+class CollectionIndex:
+    """
+    The mints of one collection (candy machine id) with their name and seller fee, as fixed size records sorted by mint.
+    With a path, the records are memory mapped from a file that all workers share and that is replaced atomically
+    on refresh (readers pick up the new file on their next lookup). Without one, they are kept in memory.
+    """
+
+    def __init__(self, candy_machine_id: str, path: Optional[str] = None) -> None:
+        self.candy_machine_id = candy_machine_id
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = b""
+        self._file = None
+        self._mtime = None
+        self._load()
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        if isinstance(self._records, mmap.mmap):
+            self._records.close()
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "rb")
+        self._mtime = mtime
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._records = b""
+        else:
+            self._records = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _find(self, mint_key: bytes) -> Optional[int]:
+        low, high = 0, len(self._records) // _RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * _RECORD.size
+            middle_key = self._records[offset:offset + _MINT_SIZE]
+            if middle_key < mint_key:
+                low = middle + 1
+            elif middle_key > mint_key:
+                high = middle
+            else:
+                return offset
+        return None
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._load()
+            return len(self._records) // _RECORD.size
+
+    def get(self, mint_key: bytes) -> Optional[Tuple[str, int]]:
+        """
+        Returns the name and seller fee basis points of the mint, None if it is not part of the collection.
+        """
+        with self._lock:
+            self._load()
+            offset = self._find(mint_key)
+            if offset is None:
+                return None
+            _, name, seller_fee_basis_points = _RECORD.unpack_from(self._records, offset)
+        return name.rstrip(b"\x00").decode("utf-8", errors="replace"), seller_fee_basis_points
+
+    def contains_many(self, mint_keys: List[bytes]) -> List[bool]:
+        with self._lock:
+            self._load()
+            return [self._find(mint_key) is not None for mint_key in mint_keys]
+
+    def write(self, records: Dict[bytes, Tuple[bytes, int]]) -> None:
+        """
+        Replaces the whole index with mint -> (name, seller fee basis points) records.
+        """
+        data = b"".join(_RECORD.pack(mint_key, name[:32], seller_fee_basis_points)
+                        for mint_key, (name, seller_fee_basis_points) in sorted(records.items()))
+        with self._lock:
+            if not self.path:
+                self._records = data
+                return
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary_path, "wb") as output_stream:
+                output_stream.write(data)
+            os.replace(temporary_path, self.path)
+            self._load()
+
+    def records(self) -> Dict[bytes, Tuple[bytes, int]]:
+        with self._lock:
+            self._load()
+            records = dict()
+            for offset in range(0, len(self._records), _RECORD.size):
+                mint_key, name, seller_fee_basis_points = _RECORD.unpack_from(self._records, offset)
+                records[mint_key] = (name, seller_fee_basis_points)
+            return records
+
+
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+
+def _index_path(candy_machine_id: str) -> Optional[str]:
+    return get_cache_path(os.path.join(COLLECTION_INDEX_DIR, f"{candy_machine_id}.idx"))
+
+
+def get_collection_index(candy_machine_id: str) -> CollectionIndex:
+    # also names the index file, so it must be a valid key (raises ValueError otherwise)
+    candy_machine_id = str(Pubkey.from_string(candy_machine_id))
+    with _indexes_lock:
+        index = _indexes.get(candy_machine_id)
+        if index is None:
+            path = _index_path(candy_machine_id)
+            if path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            index = CollectionIndex(candy_machine_id, path)
+            _indexes[candy_machine_id] = index
+        return index
+
+
+def get_existing_collection_index(candy_machine_id: str) -> Optional[CollectionIndex]:
+    """
+    Returns the index of the candy machine id only if it was already built (by this process or a shared file).
+    Request supplied ids that were never indexed are neither kept nor given a directory.
+    """
+    try:
+        candy_machine_id = str(Pubkey.from_string(candy_machine_id))
+    except ValueError:
+        return None
+    with _indexes_lock:
+        index = _indexes.get(candy_machine_id)
+    if index is None:
+        path = _index_path(candy_machine_id)
+        if not path or not os.path.exists(path):
+            return None
+        index = get_collection_index(candy_machine_id)
+    return index if len(index) else None
@@ -1,17 +1,21 @@
 import asyncio
 import platform
 
-from typing import List
+from typing import List, Optional
 
+import solana.exceptions
 from solders.rpc.responses import GetTransactionResp
 from solders.signature import Signature
 
 from . import nfts
+from . import metrics
 from . import marketplace
-from .clients import get_client, get_async_client
-from .escrows import get_escrow_nfts
-from .sells import get_nft_last_sale_batch
-from .utils import get_logger
+from .clients import get_client, get_async_client, get_scheduler
+from .transactions import get_transaction, transaction_cache_stats
+from .escrows import get_escrow_nfts, get_escrow_nfts_from_state
+from .scheduler import AdaptiveScheduler
+from .sells import get_nft_last_sale_batch, stream_nft_last_sales
+from .utils import get_logger, gather_or_cancel
 
 
 logger = get_logger("VistierAPI")
@@ -20,6 +24,50 @@ if platform.system() == 'Windows':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
+def _get_scheduler(settings: dict) -> AdaptiveScheduler:
+    # one scheduler for all requests, concurrent requests share (and adapt) a single RPC concurrency budget
+    return get_scheduler(initial_limit=max(settings['escrow_tx_workers'], settings['sales_tx_workers']),
+                         max_limit=settings['rpc_max_concurrency'],
+                         max_retries=settings['rpc_max_retries'])
+
+
+def _get_treasuries(creators: List[str]) -> List[str]:
+    # the first creator is the candy machine, unless it is the only one
+    if len(creators) == 1:
+        return creators
+    return [c for c in creators[1:]]
+
+
+async def _find_escrowed_collection_nfts(settings: dict,
+                                         solana_async_client,
+                                         wallet_address: str,
+                                         collection_candy_machine_ids: List[str],
+                                         escrow_scheduler: AdaptiveScheduler,
+                                         metadata_memo: Optional[dict]) -> List[dict]:
+    with metrics.span("escrow_scan"):
+        if settings['escrow_engine'] == "state":
+            escrowed_nfts = await get_escrow_nfts_from_state(wallet_address, scheduler=escrow_scheduler)
+        else:
+            escrowed_nfts = await get_escrow_nfts(wallet_address,
+                                                  page_size=settings['escrow_tx_to_process'],
+                                                  max_tx_cnt_to_check=settings['escrow_max_tx_to_process'],
+                                                  idle_tx_window=settings['escrow_idle_tx_window'],
+                                                  time_budget=settings['escrow_time_budget'],
+                                                  scheduler=escrow_scheduler)
+
+    targeted_collection_nfts = await nfts.find_nfts_of_collection_async(
+        solana_async_client,
+        mint_addresses=escrowed_nfts,
+        collection_candy_machin_ids=collection_candy_machine_ids,
+        metadata_memo=metadata_memo,
+        scheduler=escrow_scheduler
+    )
+
+    logger.info("Wallet has %d escrowed NFTs, out of which %d are the targeted collection",
+                len(escrowed_nfts), len(targeted_collection_nfts))
+    return targeted_collection_nfts
+
+
 async def api_search_wallet_for_nfts(settings: dict,
                                      wallet_address: str,
                                      collection_candy_machine_ids: List[str]) -> dict:
@@ -49,9 +97,132 @@ async def api_search_wallet_for_nfts(settings: dict,
     :param collection_candy_machine_ids: IDs of the collection whose NFTs we are searching for in the wallet address
     :return: a dict containing information on all the found NFTs (in wallet and escrowed)
     """
+    return await _search_wallet_for_nfts(settings,
+                                         wallet_address,
+                                         collection_candy_machine_ids,
+                                         escrow_scheduler=_get_scheduler(settings),
+                                         sales_scheduler=_get_scheduler(settings))
+
+
+async def api_search_wallets_for_nfts(settings: dict,
+                                      wallet_addresses: List[str],
+                                      collection_candy_machine_ids: List[str]) -> dict:
+    """
+    Bulk version of api_search_wallet_for_nfts, for checking whole holder lists. Work is shared across the wallets:
+    metadata is fetched once per mint, transactions once per signature, and all RPC requests of the batch run under
+    one concurrency budget. At most settings['wallet_batch_concurrency'] wallets are searched at the same time.
+    Return format:
+    {
+        "wallets": {
+            <wallet address>: <same as the api_search_wallet_for_nfts output>,
+            ...
+        },
+        "errors": {  <wallets that could not be searched>
+            <wallet address>: <error message>,
+            ...
+        }
+    }
+    :param settings: a dict containing various configuration and settings for the project
+    :param wallet_addresses: wallet addresses to search for NFTs (duplicates are searched once)
+    :param collection_candy_machine_ids: IDs of the collection whose NFTs we are searching for in the wallet addresses
+    :return: a dict with the results of each wallet
+    """
+    scheduler = _get_scheduler(settings)
+    metadata_memo = dict()
+    wallet_slots = asyncio.Semaphore(settings['wallet_batch_concurrency'])
+
+    async def search_wallet(wallet_address: str) -> dict:
+        async with wallet_slots:
+            return await _search_wallet_for_nfts(settings,
+                                                 wallet_address,
+                                                 collection_candy_machine_ids,
+                                                 escrow_scheduler=scheduler,
+                                                 sales_scheduler=scheduler,
+                                                 metadata_memo=metadata_memo)
+
+    wallet_addresses = list(dict.fromkeys(wallet_addresses))
+    logger.info("Processing %d wallets with regards to collection CM Ids: %s",
+                len(wallet_addresses), collection_candy_machine_ids)
+    results = await asyncio.gather(*[search_wallet(wallet_address) for wallet_address in wallet_addresses],
+                                   return_exceptions=True)
+
+    output = {
+        "wallets": dict(),
+        "errors": dict()
+    }
+    for wallet_address, result in zip(wallet_addresses, results):
+        if isinstance(result, Exception):
+            logger.error("Error while searching wallet %s", wallet_address, exc_info=result)
+            output['errors'][wallet_address] = _describe_error(result)
+        else:
+            output['wallets'][wallet_address] = result
+
+    logger.info("Processed %d wallets, %d failed", len(output['wallets']), len(output['errors']))
+    return output
 
-    solana_client = get_client()
 
+def _describe_error(error: Exception) -> str:
+    # same messages as the single wallet endpoint
+    if isinstance(error, ValueError):
+        return " ".join(str(arg) for arg in error.args)
+    if isinstance(error, solana.exceptions.SolanaRpcException):
+        return "Client error '429 Too Many Requests' for endpoint url"
+    return "Unexpected internal error"
+
+
+async def _find_wallet_collection_nfts(settings: dict,
+                                       wallet_address: str,
+                                       collection_candy_machine_ids: List[str],
+                                       escrow_scheduler: AdaptiveScheduler,
+                                       metadata_memo: Optional[dict]) -> List[dict]:
+    logger.info("Processing wallet %s with regards to collection CM Ids: %s", wallet_address, collection_candy_machine_ids)
+
+    solana_async_client = await get_async_client()
+
+    # the wallet tokens and the escrow scan are independent, they only meet once both are done
+    owned_nfts, escrowed_nfts = await gather_or_cancel(
+        nfts.find_wallet_nfts_async(solana_async_client, wallet_address, collection_candy_machine_ids,
+                                    binary_scan=settings['wallet_token_scan'] == "binary",
+                                    metadata_memo=metadata_memo,
+                                    scheduler=escrow_scheduler),
+        _find_escrowed_collection_nfts(settings, solana_async_client, wallet_address, collection_candy_machine_ids,
+                                       escrow_scheduler, metadata_memo)
+    )
+    logger.info("Wallet %s has %d NFTs from our collection:", wallet_address, len(owned_nfts))
+
+    # listings that leave the NFT in the wallet are already counted as owned
+    owned_mints = {owned_nft['mint'] for owned_nft in owned_nfts}
+    owned_nfts += [escrowed_nft for escrowed_nft in escrowed_nfts if escrowed_nft['mint'] not in owned_mints]
+
+    for owned_nft in owned_nfts:
+        logger.info("%-12s mint_address: %s", owned_nft['data']['name'], owned_nft['mint'])
+    return owned_nfts
+
+
+def _get_collection_treasuries(owned_nfts: List[dict]) -> List[str]:
+    collection_creator_fee = owned_nfts[0]['data']['seller_fee_basis_points']
+    nft_treasuries = _get_treasuries(owned_nfts[0]['data']['creators'])
+    logger.info("Collection has %d treasuries: %s and a creators fee tax of: %s%%",
+                len(nft_treasuries), nft_treasuries, collection_creator_fee/100)
+
+    logger.info("Processing each owned NFT to determine fee payments history")
+    return nft_treasuries
+
+
+def _log_transaction(transaction) -> None:
+    logger.info("Found a %s transaction of %s for %s SOL: %s with creators_fee: %s SOL (%.2f%%) and "
+                "marketplace_fee: %s SOL (%.2f%%)",
+                transaction.marketplace_name, transaction.type, transaction.price, transaction.sell_signature,
+                transaction.creators_fee, (transaction.creators_fee / transaction.price) * 100,
+                transaction.marketplace_fee, (transaction.marketplace_fee / transaction.price) * 100)
+
+
+async def _search_wallet_for_nfts(settings: dict,
+                                  wallet_address: str,
+                                  collection_candy_machine_ids: List[str],
+                                  escrow_scheduler: AdaptiveScheduler,
+                                  sales_scheduler: AdaptiveScheduler,
+                                  metadata_memo: Optional[dict] = None) -> dict:
     output_response = {
         "owner_address": wallet_address,
         "creator_fee_percent_on_sale": None,
@@ -65,62 +236,27 @@ async def api_search_wallet_for_nfts(settings: dict,
         "transactions": list()
     }
 
-    logger.info(f"Processing wallet {wallet_address} with regards to collection CM Ids: {collection_candy_machine_ids}")
-
-    owned_nfts = nfts.find_wallet_nfts(solana_client, wallet_address, collection_candy_machine_ids)
-    logger.info(f"Wallet {wallet_address} has {len(owned_nfts)} NFTs from our collection:")
-
-    escrowed_nfts = await get_escrow_nfts(solana_client,
-                                          wallet_address,
-                                          worker_count=settings['escrow_tx_workers'],
-                                          tx_cnt_to_check=settings['escrow_tx_to_process'],
-                                          max_tx_cnt_to_check=settings['escrow_max_tx_to_process'])
-
-    targeted_collection_nfts = nfts.find_nfts_of_collection(solana_client,
-                                                            mint_addresses=escrowed_nfts,
-                                                            collection_candy_machin_ids=collection_candy_machine_ids)
-
-    logger.info(f"Wallet has {len(escrowed_nfts)} escrowed NFTs, out of which {len(targeted_collection_nfts)} "
-                f"are the targeted collection")
-    owned_nfts += targeted_collection_nfts
-
+    owned_nfts = await _find_wallet_collection_nfts(settings, wallet_address, collection_candy_machine_ids,
+                                                    escrow_scheduler, metadata_memo)
     if not owned_nfts:
         logger.info("owner has no NFTs belonging to the targeted collection, exiting")
         return output_response
 
-    for owned_nft in owned_nfts:
-        logger.info(f"{owned_nft['data']['name']:<12} mint_address: {owned_nft['mint']}")
-
-    collection_creator_fee = owned_nfts[0]['data']['seller_fee_basis_points']
-
     output_response['owned_nfts'] = {o['mint']: o['data']['name'] for o in owned_nfts}
     output_response['owned_nfts_count'] = len(output_response['owned_nfts'])
-    output_response['creator_fee_percent_on_sale'] = collection_creator_fee/100
+    output_response['creator_fee_percent_on_sale'] = owned_nfts[0]['data']['seller_fee_basis_points']/100
 
-    creators = owned_nfts[0]['data']['creators']
-    if len(creators) == 1:
-        nft_treasuries = creators
-    else:
-        nft_treasuries = [c for c in creators[1:]]
-    logger.info(f"Collection has {len(nft_treasuries)} treasuries: {nft_treasuries} "
-                f"and a creators fee tax of: {collection_creator_fee/100}%")
-
-    logger.info("Processing each owned NFT to determine fee payments history")
+    nft_treasuries = _get_collection_treasuries(owned_nfts)
 
-    transactions = await get_nft_last_sale_batch(output_response['owned_nfts'],
-                                                 nft_treasuries,
-                                                 worker_count=settings['sales_tx_workers'],
-                                                 tx_cnt_to_check_=settings['sales_tx_to_process'],
-                                                 max_tx_cnt_to_check=settings['sales_max_tx_to_process'],
-                                                 max_nfts_to_process=settings['sales_max_nft_to_inspect'])
+    with metrics.span("sale_scan"):
+        transactions = await get_nft_last_sale_batch(output_response['owned_nfts'],
+                                                     nft_treasuries,
+                                                     tx_cnt_to_check_=settings['sales_tx_to_process'],
+                                                     max_tx_cnt_to_check=settings['sales_max_tx_to_process'],
+                                                     max_nfts_to_process=settings['sales_max_nft_to_inspect'],
+                                                     scheduler=sales_scheduler)
     for transaction in transactions:
-
-        logger.info(f"Found a {transaction.marketplace_name} transaction of {transaction.type} "
-                    f"for {transaction.price} SOL: {transaction.encoded_tx.transaction.signatures[0]} "
-                    f"with creators_fee: {transaction.creators_fee} SOL "
-                    f"({(transaction.creators_fee / transaction.price) * 100:.2f}%) and "
-                    f"marketplace_fee: {transaction.marketplace_fee} SOL "
-                    f"({(transaction.marketplace_fee / transaction.price) * 100:.2f}%)")
+        _log_transaction(transaction)
         output_response['transactions'].append(transaction.to_dict())
         output_response['fees_on_owned_nfts']['creator'] += transaction.creators_fee_lamports
         output_response['fees_on_owned_nfts']['marketplace'] += transaction.marketplace_fee_lamports
@@ -129,26 +265,108 @@ async def api_search_wallet_for_nfts(settings: dict,
             output_response['fees_on_owned_nfts']['creator'] + output_response['fees_on_owned_nfts']['marketplace']
     )
 
-    logger.info(f"output: {output_response}")
+    logger.info("Transaction cache: %s", transaction_cache_stats())
+    # the full output can hold thousands of NFTs, only its summary is worth an info line
+    logger.info("Wallet %s: %d owned NFTs, %d sales found, fees paid: %s", wallet_address,
+                output_response['owned_nfts_count'], len(output_response['transactions']),
+                output_response['fees_on_owned_nfts'])
+    logger.debug("output: %s", output_response)
     return output_response
 
 
+async def api_stream_wallet_for_nfts(settings: dict,
+                                     wallet_address: str,
+                                     collection_candy_machine_ids: List[str]):
+    """
+    Streaming version of api_search_wallet_for_nfts: an async generator of events, each yielded as soon as it is known.
+    Transactions are not kept once yielded, so memory does not grow with the number of sales.
+    Events, in order:
+    {"event": "owned_nfts", "content": {
+        "owner_address": <wallet address belonging to the owner>,
+        "creator_fee_percent_on_sale": <creator fee as percent>,
+        "owned_nfts": {<NFT mint address>: <NFT name>, ...},
+        "owned_nfts_count": <count of owned_nfts>
+    }}
+    {"event": "transaction", "content": {  <one per sale found, in the order they are found>
+        "transaction": <transaction data, same as api_process_signature>,
+        "fees_on_owned_nfts": <creator, marketplace and total fees found so far>
+    }}
+    {"event": "totals", "content": {"fees_on_owned_nfts": <same as api_search_wallet_for_nfts>}}
+    :param settings: a dict containing various configuration and settings for the project
+    :param wallet_address: wallet address to search for NFTs
+    :param collection_candy_machine_ids: IDs of the collection whose NFTs we are searching for in the wallet address
+    """
+    owned_nfts = await _find_wallet_collection_nfts(settings, wallet_address, collection_candy_machine_ids,
+                                                    escrow_scheduler=_get_scheduler(settings),
+                                                    metadata_memo=None)
+    owned = {o['mint']: o['data']['name'] for o in owned_nfts}
+    yield {
+        "event": "owned_nfts",
+        "content": {
+            "owner_address": wallet_address,
+            "creator_fee_percent_on_sale":
+                owned_nfts[0]['data']['seller_fee_basis_points']/100 if owned_nfts else None,
+            "owned_nfts": owned,
+            "owned_nfts_count": len(owned)
+        }
+    }
+
+    fees_on_owned_nfts = {
+        "creator": 0,
+        "marketplace": 0,
+        "total": 0
+    }
+    if owned_nfts:
+        transactions = stream_nft_last_sales(owned,
+                                             _get_collection_treasuries(owned_nfts),
+                                             tx_cnt_to_check_=settings['sales_tx_to_process'],
+                                             max_tx_cnt_to_check=settings['sales_max_tx_to_process'],
+                                             max_nfts_to_process=settings['sales_max_nft_to_inspect'],
+                                             scheduler=_get_scheduler(settings))
+        try:
+            async for transaction in transactions:
+                _log_transaction(transaction)
+                fees_on_owned_nfts['creator'] += transaction.creators_fee_lamports
+                fees_on_owned_nfts['marketplace'] += transaction.marketplace_fee_lamports
+                fees_on_owned_nfts['total'] = fees_on_owned_nfts['creator'] + fees_on_owned_nfts['marketplace']
+                yield {
+                    "event": "transaction",
+                    "content": {
+                        "transaction": transaction.to_dict(),
+                        "fees_on_owned_nfts": dict(fees_on_owned_nfts)
+                    }
+                }
+        finally:
+            # also stops the remaining scans when the consumer goes away early
+            await transactions.aclose()
+
+    yield {
+        "event": "totals",
+        "content": {
+            "fees_on_owned_nfts": fees_on_owned_nfts
+        }
+    }
+
+
+def refresh_collection_indexes(collection_candy_machine_ids: List[str]) -> None:
+    """
+    Builds, or incrementally refreshes, the collection index of each candy machine id. Once a collection is indexed,
+    wallet tokens that are not part of it are discarded without fetching their metadata.
+    :param collection_candy_machine_ids: IDs of the collections to index
+    """
+    solana_client = get_client()
+    for candy_machine_id in collection_candy_machine_ids:
+        try:
+            nfts.refresh_collection_index(solana_client, candy_machine_id)
+        except Exception:
+            logger.exception("Error while refreshing the collection index of %s", candy_machine_id)
+
+
 async def get_market_tx(solana_client, tx_sig: Signature, nft_treasuries: List[str]):
-    tx_response: GetTransactionResp = await solana_client.get_transaction(tx_sig=tx_sig)
+    tx_response: GetTransactionResp = await get_transaction(solana_client, tx_sig)
     if not tx_response.value:
         return
-    transaction = tx_response.value.transaction
-
-    if not marketplace.is_marketplace(transaction.transaction.message.account_keys):
-        return
-
-    if marketplace.MagicEdenTransaction.is_marketplace_tx(transaction):
-        marketplace_transaction = marketplace.MagicEdenTransaction(tx_response)
-        if marketplace_transaction.is_sale():
-            marketplace_transaction.calculate_fees(nft_treasuries)
-            return marketplace_transaction
-        return marketplace_transaction
-    return
+    return marketplace.parse_transaction(tx_response, nft_treasuries)
 
 
 async def api_process_signature(sig: str) -> dict:
@@ -172,19 +390,15 @@ async def api_process_signature(sig: str) -> dict:
     :param sig: the signature hash of the transaction to process
     :return: a dict with the transaction data
     """
-    solana_client = get_client()
     solana_async_client = await get_async_client()
     result = await get_market_tx(solana_async_client, Signature.from_string(sig), list())
     if result:
         if result.nft_mint:
-            nft_metadata = nfts.get_metadata(solana_client, result.nft_mint)
-            result.sold_nft_name = nft_metadata['data']['name']
-            creators = nft_metadata['data']['creators']
-            if len(creators) == 1:
-                nft_treasuries = creators
-            else:
-                nft_treasuries = [c for c in creators[1:]]
-            result.calculate_fees(nft_treasuries)
+            metadata = (await nfts.get_metadata_batch_async(solana_async_client, [str(result.nft_mint)]))[0]
+            # tokens without a metadata account have no name nor creators
+            if metadata is not None:
+                result.sold_nft_name = metadata.name
+                result.calculate_fees(_get_treasuries(metadata.creators))
 
         return result.to_dict()
 
@@ -192,3 +406,51 @@ async def api_process_signature(sig: str) -> dict:
     response['type'] = "Unknown"
     response['signature'] = sig
     return response
+
+
+async def api_process_signatures(settings: dict, sigs: List[str]) -> List[dict]:
+    """
+    Bulk version of api_process_signature. Transactions are fetched concurrently (packed into JSON-RPC batches by the
+    client) and grouped by mint, so that the metadata and treasuries of each mint are resolved once, in bulk.
+    :param settings: a dict containing various configuration and settings for the project
+    :param sigs: the signature hashes of the transactions to process
+    :return: a list with the transaction data of each signature, in input order (see api_process_signature).
+    Signatures that are invalid or could not be processed are returned with an "Unknown" type
+    """
+    solana_async_client = await get_async_client()
+    scheduler = _get_scheduler(settings)
+
+    async def process(sig: str):
+        return await scheduler.call(lambda: get_market_tx(solana_async_client, Signature.from_string(sig), list()))
+
+    with metrics.span("transaction_fetch"):
+        results = await asyncio.gather(*[process(sig) for sig in sigs], return_exceptions=True)
+
+    mints = list()
+    for sig, result in zip(sigs, results):
+        if isinstance(result, Exception):
+            logger.error("Error processing signature %s", sig, exc_info=result)
+        elif result and result.nft_mint and str(result.nft_mint) not in mints:
+            mints.append(str(result.nft_mint))
+
+    metadata_list = await nfts.get_metadata_batch_async(solana_async_client, mints, scheduler=scheduler)
+    mint_metadata = {mint: metadata for mint, metadata in zip(mints, metadata_list) if metadata is not None}
+    mint_treasuries = {mint: _get_treasuries(metadata.creators) for mint, metadata in mint_metadata.items()}
+
+    output = list()
+    for sig, result in zip(sigs, results):
+        if not result or isinstance(result, Exception):
+            response = marketplace.empty_marketplace_data_dict()
+            response['type'] = "Unknown"
+            response['signature'] = sig
+            output.append(response)
+            continue
+
+        metadata = mint_metadata.get(str(result.nft_mint))
+        if metadata is not None:
+            result.sold_nft_name = metadata.name
+            result.calculate_fees(mint_treasuries[str(result.nft_mint)])
+        output.append(result.to_dict())
+
+    logger.info("Processed %d signatures of %d NFTs", len(sigs), len(mints))
+    return output
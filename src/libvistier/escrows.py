@@ -1,80 +1,151 @@
+import time
 import asyncio
-import traceback
 from datetime import datetime
 
 from solana.publickey import PublicKey
+from solana.rpc.types import DataSliceOpts, MemcmpOpts
 from solders.rpc.responses import GetTransactionResp
 
 from . import marketplace
+from . import metrics
+from .marketplace.magiceden import (
+    MAGIC_EDEN_V2_PROGRAM_ID,
+    SELLER_TRADE_STATE_SELLER_OFFSET,
+    SELLER_TRADE_STATE_TOKEN_MINT_END
+)
 from .clients import get_async_client
-from .utils import split, get_logger
+from .transactions import get_transaction
+from .scheduler import AdaptiveScheduler
+from .utils import get_logger, log_tx_sampled, cancel_tasks
 
 logger = get_logger("VistierAPI")
 
 
-async def _process_tx_batch_for_escrow(signature_batch, index_base):
+async def _process_tx_for_escrow(solana_client, scheduler: AdaptiveScheduler, index, transaction):
+    if log_tx_sampled(index):
+        logger.info("Processing #%d tx:%s from %s", index + 1, transaction.signature,
+                    datetime.fromtimestamp(transaction.block_time))
+
+    tx_response: GetTransactionResp = await scheduler.call(lambda: get_transaction(solana_client,
+                                                                                   transaction.signature))
+    metrics.increment("vistier_escrow_transactions_total")
+    if not tx_response.value:
+        return None
+    marketplace_transaction = marketplace.parse_transaction(tx_response)
+    if marketplace_transaction is None:
+        return None
+
+    if marketplace_transaction.is_escrow():
+        return "listed", str(marketplace_transaction.nft_mint)
+
+    if marketplace_transaction.is_sale():
+        return "sale", str(marketplace_transaction.nft_mint)
+
+    return None
+
+
+async def _get_signatures_page(solana_client, scheduler: AdaptiveScheduler, wallet_address, before, page_size):
+    signature_batch = await scheduler.call(lambda: solana_client.get_signatures_for_address(
+        PublicKey(wallet_address), before=before, limit=page_size))
+    return signature_batch.value
+
+
+async def get_escrow_nfts(wallet_address, page_size, max_tx_cnt_to_check, idle_tx_window, time_budget,
+                          scheduler: AdaptiveScheduler):
+    """
+    Pages backwards through the wallet history looking for NFTs it currently has listed (escrowed).
+    Each page is processed as soon as it arrives, while the next one is already being fetched.
+    The scan stops when the history ends, when idle_tx_window transactions in a row show no listing or sale,
+    or when max_tx_cnt_to_check transactions or time_budget seconds are used.
+    """
     solana_client = await get_async_client()
-    ledger = dict()
-
-    for index, transaction in enumerate(signature_batch):
-        block_time = datetime.fromtimestamp(transaction.block_time)
-
-        signature = transaction.signature
-
-        logger.info(f"Processing #{index_base + index + 1} tx:{signature} from {block_time}")
-        try:
-            tx_response: GetTransactionResp = await solana_client.get_transaction(tx_sig=signature)
-            marketplace_transaction = marketplace.MagicEdenTransaction(tx_response)
-
-            if marketplace_transaction.is_escrow():
-                mint = str(marketplace_transaction.nft_mint)
-                if mint not in ledger:
-                    ledger[mint] = {
-                        "type": "listed",
-                        "timestamp": transaction.block_time,
-                        "index": index_base + index
-                    }
-
-            if marketplace_transaction.is_sale():
-                mint = str(marketplace_transaction.nft_mint)
-                if mint not in ledger:
-                    ledger[mint] = {
-                        "type": "sale",
-                        "timestamp": transaction.block_time,
-                        "index": index_base + index
-                    }
-
-        except Exception:
-            logger.error(f"Error processing transaction: {signature}:{traceback.format_exc()}")
-
-    return ledger
-
-
-async def get_escrow_nfts(solana_client, nft_mint_address, tx_cnt_to_check, worker_count, max_tx_cnt_to_check):
-    query_chunk_size = min(max_tx_cnt_to_check, tx_cnt_to_check)
-    signature_batch = solana_client.get_signatures_for_address(PublicKey(nft_mint_address), limit=query_chunk_size)
-
-    background_tasks = list()
-
-    index_base = 0
-    for batch in split(signature_batch.value, worker_count):
-        background_tasks.append(_process_tx_batch_for_escrow(batch, index_base))
-        index_base += len(batch)
-
-    results = await asyncio.gather(*background_tasks)
-    position_mapped = dict()
-    for parts in results:
-        for mint, tx_data in parts.items():
-            position_mapped[tx_data['index']] = {
-                "type": tx_data['type'],
-                "mint": mint,
-                "timestamp": tx_data["timestamp"]
-            }
-    sorted_dict = dict(sorted(position_mapped.items()))
+    deadline = time.monotonic() + time_budget
+
+    # signatures are newest first, so the first time a mint is seen is its current state
     seen = set()
     output = list()
-    for timestamp, tx_data in sorted_dict.items():
-        if tx_data['mint'] not in seen and tx_data['type'] == "listed":
-            output.append(tx_data['mint'])
-        seen.add(tx_data['mint'])
+    checked = 0
+    idle = 0
+
+    tasks = list()
+    next_page = asyncio.ensure_future(_get_signatures_page(solana_client, scheduler, wallet_address, None,
+                                                           min(page_size, max_tx_cnt_to_check)))
+    try:
+        while next_page is not None:
+            signatures = await next_page
+            next_page = None
+
+            checked_after_page = checked + len(signatures)
+            if len(signatures) == page_size and checked_after_page < max_tx_cnt_to_check:
+                next_page = asyncio.ensure_future(_get_signatures_page(
+                    solana_client, scheduler, wallet_address, signatures[-1].signature,
+                    min(page_size, max_tx_cnt_to_check - checked_after_page)))
+
+            tasks = [
+                asyncio.ensure_future(_process_tx_for_escrow(solana_client, scheduler, checked + index, transaction))
+                for index, transaction in enumerate(signatures)
+            ]
+            pending = set()
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+                cancel_tasks(pending)
+
+            for transaction, task in zip(signatures, tasks):
+                if task in pending:
+                    # out of time, the ledger is only valid up to the first transaction that was not checked
+                    logger.warning("Escrow scan time budget of %ss used after %d transactions", time_budget, checked)
+                    return output
+                checked += 1
+                if task.exception() is not None:
+                    logger.error("Error processing transaction: %s", transaction.signature,
+                                 exc_info=task.exception())
+                    idle += 1
+                    continue
+                result = task.result()
+                if result is None:
+                    idle += 1
+                    continue
+                idle = 0
+                tx_type, mint = result
+                if mint not in seen and tx_type == "listed":
+                    output.append(mint)
+                seen.add(mint)
+
+            if idle >= idle_tx_window:
+                logger.info("No escrow activity in the last %d transactions, stopping after %d", idle, checked)
+                break
+            if time.monotonic() >= deadline:
+                logger.warning("Escrow scan time budget of %ss used after %d transactions", time_budget, checked)
+                break
+    finally:
+        # the scan may stop (or be cancelled) with the next page and transactions of the current one in flight
+        cancel_tasks(tasks)
+        if next_page is not None:
+            cancel_tasks([next_page])
+
+    return output
+
+
+async def get_escrow_nfts_from_state(wallet_address, scheduler: AdaptiveScheduler):
+    """
+    Finds the NFTs the wallet currently has listed on Magic Eden from on-chain state instead of its history:
+    a listing lives exactly as long as its seller trade state account, so the live ones of the wallet are the listings.
+    A single getProgramAccounts call, whatever the size of the wallet history.
+    """
+    solana_client = await get_async_client()
+
+    # only the account head (discriminator up to the token mint) is needed, not the whole account
+    program_accounts = await scheduler.call(lambda: solana_client.get_program_accounts(
+        PublicKey(MAGIC_EDEN_V2_PROGRAM_ID),
+        encoding="base64",
+        data_slice=DataSliceOpts(offset=0, length=SELLER_TRADE_STATE_TOKEN_MINT_END),
+        filters=[MemcmpOpts(offset=SELLER_TRADE_STATE_SELLER_OFFSET, bytes=str(wallet_address))]
+    ))
+
+    output = list()
+    for keyed_account in program_accounts.value:
+        mint = marketplace.decode_seller_trade_state_mint(keyed_account.account.data)
+        if mint is not None and mint not in output:
+            output.append(mint)
+    logger.info("Wallet %s has %d live Magic Eden listings", wallet_address, len(output))
     return output
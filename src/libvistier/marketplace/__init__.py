@@ -1,9 +1,14 @@
 from .templates import (
     marketplaces_ids,
+    marketplaces_keys,
     is_marketplace,
+    match_accounts,
+    treasury_keys,
     empty_marketplace_data_dict,
     MarketplaceIds,
     MarketplaceInstructions
 )
 
-from .magiceden import MagicEdenTransaction
+from .magiceden import MagicEdenTransaction, decode_seller_trade_state_mint
+from .records import SaleRecord, keep_raw_transactions
+from .registry import register_parser, get_parser, parse_transaction
@@ -1,24 +1,159 @@
+import re
 import json
-from typing import List
+import time
+import struct
+import hashlib
+from typing import List, Optional
 
+import base58
+from solders.pubkey import Pubkey
 from solders.rpc.responses import GetTransactionResp
-from solders.transaction_status import EncodedTransactionWithStatusMeta
-from .templates import MarketplaceInstructions, MarketplaceIds
+from solders.transaction_status import EncodedTransactionWithStatusMeta, UiRawMessage
+from .templates import MarketplaceInstructions, MarketplaceIds, match_accounts, treasury_keys
+from .. import metrics
 from ..utils import get_logger
 
 MAGIC_EDEN_ESCROW_WALLET = "1BWutmTvYPwDtmw9abTkS4Ssr8no61spGAvW1X6NDix"
+MAGIC_EDEN_V2_PROGRAM_ID = "M2mx93ekt1fmXSVkTrUL9xVFHkmME8HTUi5Cyc5aF7K"
+
+# a seller trade state account exists for as long as the listing does, it is closed when the NFT is sold or delisted.
+# Layout: discriminator (8), auction house (32), seller (32), seller referral (32), price (u64), token mint (32), ...
+SELLER_TRADE_STATE_DISCRIMINATORS = {
+    hashlib.sha256(f"account:{name}".encode()).digest()[:8] for name in ("SellerTradeState", "SellerTradeStateV2")
+}
+SELLER_TRADE_STATE_SELLER_OFFSET = 40
+SELLER_TRADE_STATE_TOKEN_MINT_OFFSET = 112
+SELLER_TRADE_STATE_TOKEN_MINT_END = SELLER_TRADE_STATE_TOKEN_MINT_OFFSET + 32
+
+SYSTEM_PROGRAM_ID = "11111111111111111111111111111111"
+
+_M2_PROGRAM_KEY = Pubkey.from_string(MAGIC_EDEN_V2_PROGRAM_ID)
+
+
+def _anchor_discriminator(instruction_name: str) -> bytes:
+    return hashlib.sha256(f"global:{instruction_name}".encode()).digest()[:8]
+
+
+# Magic Eden v2 instruction discriminator -> (instruction, offset of the u64 buyer price in the instruction data).
+# Arguments, from the M2 IDL, after the 8 byte discriminator:
+#  - sell, buy: two u8 bumps, buyer price, token size, expiry
+#  - execute_sale_v2: two u8 bumps, buyer price, token size, buyer and seller expiry, maker and taker fee
+#  - cancel_sell, cancel_buy: buyer price, token size, expiry
+M2_INSTRUCTIONS = {
+    _anchor_discriminator(instruction_name): (instruction_name, price_offset)
+    for instruction_name, price_offset in (
+        ("execute_sale_v2", 10),
+        ("sell", 10),
+        ("buy", 10),
+        ("cancel_sell", 8),
+        ("cancel_buy", 8),
+        ("deposit", None),
+        ("withdraw", None),
+    )
+}
+
+# M2 instruction -> transaction type, in order of precedence (e.g. a buy executed right away is a sale)
+M2_INSTRUCTION_TYPES = (
+    ("execute_sale_v2", MarketplaceInstructions.Sale),
+    ("sell", MarketplaceInstructions.Listing),
+    ("cancel_buy", MarketplaceInstructions.CancelOffer),
+    ("buy", MarketplaceInstructions.PlaceOffer),
+)
+
+# position of the participants in the accounts of the M2 instructions
+M2_EXECUTE_SALE_BUYER_ACCOUNT = 0
+M2_EXECUTE_SALE_SELLER_ACCOUNT = 1
+M2_EXECUTE_SALE_MINT_ACCOUNT = 4
+M2_SELL_SELLER_ACCOUNT = 0
+M2_SELL_MINT_ACCOUNT = 4
+
+# the log lines instruction elements are built from:
+#  - Program <program id> invoke [<depth>]      starts a new element
+#  - Program log: Instruction: <instruction>   names the instruction of the current element
+#  - Program log: {...}                        JSON printed by the current element, e.g. {"price": ...}
+# _LOG_TOKENS finds them all at once in the joined logs (see _join_logs), skipping any other line in the regex engine
+_LOG_TOKEN = re.compile(r"Program (?:log: (?:Instruction: (.*)|(\{.*\}))|(\S+) invoke \[(\d+)\])$")
+_LOG_TOKENS = re.compile(r"\nProgram (?:log: (?:Instruction: (.*)|(\{.*\}))|(\S+) invoke \[(\d+)\])(?=\n)")
+
+# the instructions transactions are classified on
+_CLASSIFIED_INSTRUCTIONS = re.compile(r"\nProgram log: Instruction: (ExecuteSale|Sell|CancelBuy|Buy)(?=\n)")
+
+# instructions whose printed JSON is decoded when the logs are split, the others keep it raw
+_DECODED_INSTRUCTIONS = ("Sell", "ExecuteSale")
+
 logger = get_logger("VistierAPI")
 
 
+def decode_seller_trade_state_mint(data: bytes) -> Optional[str]:
+    """
+    Returns the listed token mint if the account data (at least up to the token mint) is a seller trade state.
+    """
+    if len(data) < SELLER_TRADE_STATE_TOKEN_MINT_END or data[:8] not in SELLER_TRADE_STATE_DISCRIMINATORS:
+        return None
+    return str(Pubkey.from_bytes(data[SELLER_TRADE_STATE_TOKEN_MINT_OFFSET:SELLER_TRADE_STATE_TOKEN_MINT_END]))
+
+
+def _decode_instruction_data(data: str) -> bytes:
+    # same as base58.b58decode, which converts the decoded number to bytes one divmod at a time, to_bytes is native
+    number = base58.b58decode_int(data)
+    leading_zeros = len(data) - len(data.lstrip("1"))
+    return b"\0" * leading_zeros + number.to_bytes((number.bit_length() + 7) // 8, "big")
+
+
+def _join_logs(log_messages: List[str]) -> str:
+    # every line between new lines, as _LOG_TOKENS and _CLASSIFIED_INSTRUCTIONS expect them
+    return "\n%s\n" % "\n".join(log_messages)
+
+
+def _decode_data(data: str) -> Optional[dict]:
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        logger.error("exception when processing line: %s:\n%s", data, e.args)
+        return None
+
+
+def _last_instruction_price(log_messages: List[str]) -> Optional[int]:
+    """
+    The price printed in the last element of the split logs (see MagicEdenTransaction._process_logs), found by
+    walking the logs backwards, only up to the start of that element.
+    """
+    data = None
+    instruction = None
+    for log_msg in reversed(log_messages):
+        token = _LOG_TOKEN.match(log_msg)
+        if token is None:
+            continue
+        line_instruction, line_data, program_id, _ = token.groups()
+        if program_id:
+            if program_id == SYSTEM_PROGRAM_ID:
+                continue
+            if instruction:
+                break
+            # elements without an instruction are not part of the split logs
+            data = instruction = None
+        elif line_data:
+            if data is None:
+                data = line_data
+        elif instruction is None:
+            instruction = line_instruction
+    else:
+        if not instruction:
+            return None
+
+    extra_data = _decode_data(data) if data is not None else None
+    return extra_data.get('price') if extra_data is not None else None
+
+
 class MagicEdenTransaction:
 
     @staticmethod
     def is_marketplace_tx(encoded_tx: EncodedTransactionWithStatusMeta) -> bool:
-        return len(set(str(a) for a in encoded_tx.transaction.message.account_keys).intersection(
-            MarketplaceIds.MagicEden.ids)) > 0
+        return not MarketplaceIds.MagicEden.keys.isdisjoint(encoded_tx.transaction.message.account_keys)
 
     def __init__(self, transaction_response: GetTransactionResp) -> None:
         #
+        started = time.perf_counter()
         self.ids = MarketplaceIds.MagicEden.ids
         self.fee_ids = MarketplaceIds.MagicEden.fee_ids
         self.encoded_tx = transaction_response.value.transaction
@@ -27,21 +162,24 @@ class MagicEdenTransaction:
         self.creators_fee_lamports = 0
         self.price_lamports = None
         self.type = None
-        self.executed_instructions = None
+        self._executed_instructions = None
         self.sold_nft_name = None
         self.nft_mint = None
 
         self.sell_signature = self.encoded_tx.transaction.signatures[0]
         self.sell_block_time = transaction_response.value.block_time
 
-        self._process_logs()
-        self._determine_transaction_type()
-
         self.seller_address = None
         self.buyer_address = None
 
-        if self.is_sale() or self.is_listing():
-            self._set_participants()
+        if not self._decode_instructions():
+            # no (known) Magic Eden v2 instruction, e.g. Magic Eden v1, the logs tell what happened
+            self._determine_transaction_type()
+            if self.is_sale() or self.is_listing():
+                self._set_participants()
+
+        metrics.increment("vistier_transactions_parsed_total", marketplace=self.marketplace_name, type=self.type)
+        metrics.observe("vistier_transaction_parse_seconds", time.perf_counter() - started)
 
     @property
     def marketplace_name(self) -> str:
@@ -59,6 +197,13 @@ class MagicEdenTransaction:
     def creators_fee(self) -> int:
         return self.creators_fee_lamports / 10 ** 9
 
+    @property
+    def executed_instructions(self) -> List[dict]:
+        # split lazily, most transactions are classified without them
+        if self._executed_instructions is None:
+            self._executed_instructions = self._process_logs(_join_logs(self.encoded_tx.meta.log_messages))
+        return self._executed_instructions
+
     def is_sale(self) -> bool:
         return self.type == MarketplaceInstructions.Sale
 
@@ -68,94 +213,118 @@ class MagicEdenTransaction:
     def is_escrow(self) -> bool:
         return self.is_listing()
 
-    def _process_logs(self) -> None:
+    @staticmethod
+    def _process_logs(logs: str) -> List[dict]:
         """
+        Splits the (joined) logs in executed instruction elements. Printed JSON is kept raw (under 'data') and only
+        decoded (to 'extra_data') for sell instructions.
+
         Can probably get this information using https://docs.solana.fm/v3-api-reference/enriched-transfers
         or Magic Eden API
         """
         all_elements = list()
-        element = {"logs": []}
-        for log_msg in self.encoded_tx.meta.log_messages:
-            try:
-                if not log_msg.startswith("Program "):
-                    logger.warning(f"Unknown log message case: {log_msg}, skipping")
+        element = dict()
+        for instruction, data, program_id, depth in _LOG_TOKENS.findall(logs):
+            if program_id:
+                if program_id == SYSTEM_PROGRAM_ID:
+                    # skipping, pollutes with no added value
                     continue
-                log_msg = log_msg.replace("Program ", "")
-
-                if log_msg.startswith("return: "):
-                    _, _, return_value = log_msg.split(" ")
-                    element['return'] = return_value
-                elif log_msg.startswith("log: "):
-                    log_msg = log_msg.replace("log: ", "")
-
-                    if log_msg.startswith("Instruction: "):
-                        element['instruction'] = log_msg[len("Instruction: "):]
-                        continue
-                    if log_msg.startswith("{") and log_msg.endswith("}"):
-                        element['extra_data'] = json.loads(log_msg)
-                    element['logs'].append(log_msg)
-                else:
-                    parts = log_msg.split(" ")
-                    if parts[0] in ['11111111111111111111111111111111']:
-                        # skipping, pollutes with no added value and crashes code
-                        continue
-
-                    if len(parts) == 2:
-                        program_id, status = parts
-                        # only care about the status of the high level execution
-                        if element.get("program_id") == program_id:
-                            element["status"] = status
-                    elif len(parts) == 3:
-                        program_id, command, level = parts
-
-                        if element.get("instruction"):
-                            all_elements.append(element)
-
-                        element = {"logs": [], 'depth': int(level[1:-1]), "program_id": program_id}
-                    else:
-                        # print(f"Untreated cases: {log_msg}")
-                        # for example: TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA consumed 4645 of 463072 compute units
-                        pass
-
-            except Exception as e:
-                logger.error(f"exception when processing line: {log_msg}:\n{e.args}")
+                if element.get("instruction"):
+                    all_elements.append(element)
+                element = {'depth': int(depth), "program_id": program_id}
+            elif data:
+                element['data'] = data
+            else:
+                element['instruction'] = instruction
         if element.get("instruction"):
             all_elements.append(element)
 
-        self.executed_instructions = all_elements
+        for element in all_elements:
+            if 'data' in element and element['instruction'] in _DECODED_INSTRUCTIONS:
+                extra_data = _decode_data(element['data'])
+                if extra_data is not None:
+                    element['extra_data'] = extra_data
+
+        return all_elements
+
+    def _decode_instructions(self) -> bool:
+        """
+        Classifies the transaction from its top level Magic Eden v2 instructions: the Anchor discriminator names
+        the instruction, its arguments hold the price and its accounts the participants.
+        :return: False if there is no M2 instruction or one that is not known, for the logs to decide
+        """
+        message = self.encoded_tx.transaction.message
+        if not isinstance(message, UiRawMessage):
+            return False
+        account_keys = message.account_keys
+        loaded_addresses = self.encoded_tx.meta.loaded_addresses
+        if loaded_addresses:
+            account_keys = account_keys + loaded_addresses.writable + loaded_addresses.readonly
+
+        m2_instructions = dict()
+        for compiled_instruction in message.instructions:
+            if account_keys[compiled_instruction.program_id_index] != _M2_PROGRAM_KEY:
+                continue
+            data = _decode_instruction_data(compiled_instruction.data)
+            known_instruction = M2_INSTRUCTIONS.get(data[:8])
+            if known_instruction is None:
+                return False
+            instruction_name, price_offset = known_instruction
+            m2_instructions.setdefault(instruction_name, (data, price_offset, compiled_instruction.accounts))
+        if not m2_instructions:
+            return False
+
+        for instruction_name, instruction_type in M2_INSTRUCTION_TYPES:
+            if instruction_name in m2_instructions:
+                break
+        else:
+            # e.g. a delisting, a deposit or a withdrawal
+            instruction_name = next(iter(m2_instructions))
+            instruction_type = MarketplaceInstructions.Unknown
+
+        data, price_offset, accounts = m2_instructions[instruction_name]
+        try:
+            price_lamports = struct.unpack_from("<Q", data, price_offset)[0] if price_offset is not None else None
+            if instruction_type == MarketplaceInstructions.Sale:
+                participants = (account_keys[accounts[M2_EXECUTE_SALE_SELLER_ACCOUNT]],
+                                account_keys[accounts[M2_EXECUTE_SALE_BUYER_ACCOUNT]],
+                                account_keys[accounts[M2_EXECUTE_SALE_MINT_ACCOUNT]])
+            elif instruction_type == MarketplaceInstructions.Listing:
+                participants = (account_keys[accounts[M2_SELL_SELLER_ACCOUNT]],
+                                None,
+                                account_keys[accounts[M2_SELL_MINT_ACCOUNT]])
+            else:
+                participants = (None, None, None)
+        except (struct.error, IndexError):
+            logger.warning("Malformed Magic Eden v2 %s instruction in %s", instruction_name, self.sell_signature)
+            return False
+
+        self.type = instruction_type
+        self.price_lamports = price_lamports
+        self.seller_address, self.buyer_address, self.nft_mint = participants
+        return True
 
     def _determine_transaction_type(self) -> None:
+        log_messages = self.encoded_tx.meta.log_messages
+        logs = _join_logs(log_messages)
+        # which instructions ran decides most types, the logs are only split when the shape of the transaction matters
+        instructions = set(_CLASSIFIED_INSTRUCTIONS.findall(logs))
 
-        has_execute_sell = False
-        has_sell = False
-        has_cancel_buy = False
-        has_buy = False
-        price = None
-        for execution in self.executed_instructions:
-            # in some cases the price is printed in a Sell in others in a CloseAccount
-            price = execution.get('extra_data', {}).get('price')
-
-            if execution['instruction'] == "ExecuteSale":
-                has_execute_sell = True
-            if execution['instruction'] == "Sell":
-                has_sell = True
-            if execution['instruction'] == "CancelBuy":
-                has_cancel_buy = True
-            if execution['instruction'] == "Buy":
-                has_buy = True
-
-        self.price_lamports = price
-
-        if has_execute_sell:
+        # in some cases the price is printed in a Sell in others in a CloseAccount
+        self.price_lamports = _last_instruction_price(log_messages)
+
+        if "ExecuteSale" in instructions:
             self.type = MarketplaceInstructions.Sale
-        elif has_sell:
+        elif "Sell" in instructions:
+            self._executed_instructions = self._process_logs(logs)
             if 1 <= len(self.executed_instructions) <= 2:
                 ins_0 = self.executed_instructions[0]
                 if ins_0['instruction'] == "Sell":
                     self.type = MarketplaceInstructions.Listing
-        elif has_cancel_buy:
+        elif "CancelBuy" in instructions:
             self.type = MarketplaceInstructions.CancelOffer
-        elif has_buy:
+        elif "Buy" in instructions:
+            self._executed_instructions = self._process_logs(logs)
             if len(self.executed_instructions) == 1:
                 ins_0 = self.executed_instructions[0]
                 if ins_0['instruction'] == "Buy":
@@ -163,24 +332,28 @@ class MagicEdenTransaction:
         else:
             self.type = MarketplaceInstructions.Unknown
 
-    def calculate_fees(self, treasuries_accounts: List[str]) -> None:
+    def calculate_fees(self, treasuries_accounts, account_match=None) -> None:
+        """
+        :param treasuries_accounts: the creator treasury addresses, or their keys (see templates.treasury_keys)
+        :param account_match: the templates.match_accounts result of this transaction for these treasuries,
+        if already known
+        """
+        started = time.perf_counter()
         pre_balances = self.encoded_tx.meta.pre_balances
         post_balances = self.encoded_tx.meta.post_balances
 
-        marketplace_index = -1
-        treasury_index = -1
-
-        for index, account in enumerate(self.encoded_tx.transaction.message.account_keys):
-            if str(account) in self.fee_ids:
-                marketplace_index = index
-            if str(account) in treasuries_accounts:
-                treasury_index = index
+        if account_match is None:
+            account_match = match_accounts(self.encoded_tx.transaction.message.account_keys,
+                                           treasury_keys(treasuries_accounts), (MarketplaceIds.MagicEden,))
+        _, marketplace_index, treasury_indexes = account_match
+        treasury_index = treasury_indexes[-1] if treasury_indexes else -1
 
         if marketplace_index > 0:
             self.marketplace_fee_lamports = int(post_balances[marketplace_index] - pre_balances[marketplace_index])
 
         if treasury_index > 0:
             self.creators_fee_lamports = int(post_balances[treasury_index] - pre_balances[treasury_index])
+        metrics.observe("vistier_fee_calculation_seconds", time.perf_counter() - started)
 
     def _set_participants(self):
         pre_token_balances = self.encoded_tx.meta.pre_token_balances
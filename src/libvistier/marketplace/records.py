@@ -0,0 +1,76 @@
+import os
+
+# set to 1 to keep the raw transaction (encoded_tx) of the sale records made from parsed transactions, for debugging.
+# Otherwise only the sale fields are kept and the transaction is released as soon as the sale is recorded
+KEEP_RAW_TRANSACTIONS_ENV = 'VISTIER_KEEP_RAW_TRANSACTIONS'
+
+_keep_raw_transactions = None
+
+
+def keep_raw_transactions() -> bool:
+    # read lazily so that it can be configured (e.g. via .env) after import
+    global _keep_raw_transactions
+    if _keep_raw_transactions is None:
+        _keep_raw_transactions = os.environ.get(KEEP_RAW_TRANSACTIONS_ENV, "").lower() in ("1", "true", "yes")
+    return _keep_raw_transactions
+
+
+class SaleRecord:
+    """
+    A marketplace transaction in its to_dict() form (e.g. restored from the last sale index, or recorded from a parsed
+    sale once its fees are calculated). Exposes the same attributes as the marketplace transaction classes, so both
+    can be used interchangeably, without holding on to the whole decoded transaction.
+    """
+
+    __slots__ = ("sell_signature", "sell_block_time", "nft_mint", "sold_nft_name", "marketplace_name",
+                 "price_lamports", "creators_fee_lamports", "marketplace_fee_lamports", "seller_address",
+                 "buyer_address", "type", "encoded_tx")
+
+    def __init__(self, data: dict, encoded_tx=None) -> None:
+        self.sell_signature = data['signature']
+        self.sell_block_time = data['block_time']
+        self.nft_mint = data['mint']
+        self.sold_nft_name = data['name']
+        self.marketplace_name = data['source']
+        self.price_lamports = data['price']
+        self.creators_fee_lamports = data['creator_fee_paid']
+        self.marketplace_fee_lamports = data['market_fee_paid']
+        self.seller_address = data['seller']
+        self.buyer_address = data['buyer']
+        self.type = data['type']
+        # only set with KEEP_RAW_TRANSACTIONS_ENV
+        self.encoded_tx = encoded_tx
+
+    @classmethod
+    def from_transaction(cls, transaction) -> "SaleRecord":
+        """
+        Records a parsed marketplace transaction (with its fees already calculated).
+        """
+        return cls(transaction.to_dict(), encoded_tx=transaction.encoded_tx if keep_raw_transactions() else None)
+
+    @property
+    def price(self) -> int:
+        return self.price_lamports / 10 ** 9
+
+    @property
+    def marketplace_fee(self) -> int:
+        return self.marketplace_fee_lamports / 10 ** 9
+
+    @property
+    def creators_fee(self) -> int:
+        return self.creators_fee_lamports / 10 ** 9
+
+    def to_dict(self):
+        return {
+            'signature': self.sell_signature,
+            'block_time': self.sell_block_time,
+            "mint": self.nft_mint,
+            'name': self.sold_nft_name,
+            'source': self.marketplace_name,
+            'price': self.price_lamports,
+            'creator_fee_paid': self.creators_fee_lamports,
+            'market_fee_paid': self.marketplace_fee_lamports,
+            'seller': self.seller_address,
+            'buyer': self.buyer_address,
+            'type': self.type
+        }
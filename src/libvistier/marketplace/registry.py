@@ -0,0 +1,49 @@
+from typing import Optional
+
+from solders.rpc.responses import GetTransactionResp
+
+from .templates import MarketplaceIds, marketplaces_keys, match_accounts, treasury_keys
+from .magiceden import MagicEdenTransaction
+
+# marketplace (MarketplaceIds class) -> class parsing its transactions. A parser is built from the GetTransactionResp
+# and provides is_sale(), is_listing(), is_escrow(), calculate_fees(treasuries, account_match) and to_dict().
+# Transactions of the other marketplaces are recognized, but not parsed
+_parsers = dict()
+
+
+def register_parser(marketplace: type, parser_class: type) -> None:
+    """
+    Transactions calling any program id of the marketplace are handed to parser_class from now on.
+    """
+    _parsers[marketplace] = parser_class
+
+
+def get_parser(marketplace: type) -> Optional[type]:
+    return _parsers.get(marketplace)
+
+
+def parse_transaction(transaction_response: GetTransactionResp, treasuries=None):
+    """
+    Hands the transaction to the parser of the marketplace program it calls.
+    :param treasuries: if given, the fees of a sale are calculated for these creator treasuries
+    :return: the parsed transaction, None if it does not call a marketplace that has a parser
+    """
+    account_keys = transaction_response.value.transaction.transaction.message.account_keys
+    # most transactions are not marketplace ones, a single set probe turns them down
+    if marketplaces_keys.isdisjoint(account_keys):
+        return None
+
+    # the first marketplace program that has a parser decides, other marketplace programs may come before it
+    account_match = match_accounts(account_keys, treasury_keys(treasuries) if treasuries is not None else frozenset(),
+                                   _parsers)
+    parser_class = _parsers.get(account_match[0])
+    if parser_class is None:
+        return None
+
+    marketplace_transaction = parser_class(transaction_response)
+    if treasuries is not None and marketplace_transaction.is_sale():
+        marketplace_transaction.calculate_fees(treasuries, account_match)
+    return marketplace_transaction
+
+
+register_parser(MarketplaceIds.MagicEden, MagicEdenTransaction)
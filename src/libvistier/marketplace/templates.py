@@ -1,7 +1,9 @@
 import inspect
-from functools import reduce
+from functools import reduce, lru_cache
+from typing import FrozenSet, Iterable, List, Optional, Tuple
 
 from solana.publickey import PublicKey
+from solders.pubkey import Pubkey
 
 
 class MarketplaceInstructions:
@@ -93,8 +95,74 @@ marketplaces_ids = reduce(set.union, [cls_attribute.ids for cls_attribute in Mar
                                       if inspect.isclass(cls_attribute)])
 
 
+def _to_keys(addresses: Iterable[str]) -> FrozenSet[Pubkey]:
+    return frozenset(Pubkey.from_string(address) for address in addresses)
+
+
+# the ids above decoded once, account keys of transactions are matched against them without base58 encoding them
+for _marketplace in MarketplaceIds.__dict__.values():
+    if inspect.isclass(_marketplace):
+        _marketplace.keys = _to_keys(_marketplace.ids)
+        _marketplace.fee_keys = _to_keys(_marketplace.fee_ids)
+        _marketplace.escrow_keys = _to_keys(_marketplace.escrow_ids)
+
+marketplaces_keys = _to_keys(marketplaces_ids)
+
+# account key -> marketplace (MarketplaceIds class) of the marketplace programs and, respectively, fee accounts
+_marketplace_programs = {key: _marketplace for _marketplace in MarketplaceIds.__dict__.values()
+                         if inspect.isclass(_marketplace) for key in _marketplace.keys}
+_marketplace_fee_accounts = {key: _marketplace for _marketplace in MarketplaceIds.__dict__.values()
+                             if inspect.isclass(_marketplace) for key in _marketplace.fee_keys}
+
+
+@lru_cache(maxsize=1024)
+def _decoded_treasuries(treasuries: Tuple[str, ...]) -> FrozenSet[Pubkey]:
+    keys = set()
+    for treasury in treasuries:
+        try:
+            keys.add(Pubkey.from_string(treasury))
+        except ValueError:
+            # not an account address, so it can not match any account of a transaction
+            continue
+    return frozenset(keys)
+
+
+def treasury_keys(treasuries) -> FrozenSet[Pubkey]:
+    """
+    The treasury addresses as account keys, decoded once per distinct list. Already decoded keys are returned as is.
+    """
+    if isinstance(treasuries, frozenset):
+        return treasuries
+    return _decoded_treasuries(tuple(treasuries))
+
+
 def is_marketplace(account_keys):
-    return len(set(str(a) for a in account_keys).intersection(marketplaces_ids)) > 0
+    return not marketplaces_keys.isdisjoint(account_keys)
+
+
+def match_accounts(account_keys, treasuries: FrozenSet[Pubkey] = frozenset(),
+                   marketplaces=None) -> Tuple[Optional[type], int, List[int]]:
+    """
+    Single pass over the account keys of a transaction.
+    :param marketplaces: if given, only the programs of these marketplaces (MarketplaceIds classes) are looked for.
+    Transactions also call unrelated marketplace programs (e.g. a candy machine listed before Magic Eden)
+    :return: the marketplace (MarketplaceIds class) of the first marketplace program found, None if there is none,
+    the index of its (last) fee account, -1 if there is none, and the indices of the treasury accounts
+    """
+    marketplace = None
+    fee_indexes = dict()
+    treasury_indexes = list()
+    for index, account_key in enumerate(account_keys):
+        if marketplace is None:
+            program_marketplace = _marketplace_programs.get(account_key)
+            if program_marketplace is not None and (marketplaces is None or program_marketplace in marketplaces):
+                marketplace = program_marketplace
+        fee_account_marketplace = _marketplace_fee_accounts.get(account_key)
+        if fee_account_marketplace is not None:
+            fee_indexes[fee_account_marketplace] = index
+        if account_key in treasuries:
+            treasury_indexes.append(index)
+    return marketplace, fee_indexes.get(marketplace, -1), treasury_indexes
 
 
 METADATA_PROGRAM_ID = PublicKey('metaqbxxUerdq28cj1RbAWkYQm3ybzjb6a8bt518x1s')
@@ -0,0 +1,161 @@
+import os
+import time
+import threading
+import contextvars
+
+from contextlib import nullcontext
+from typing import List, Optional
+
+# set to 1 (or true) to collect metrics. When not set every call below is a no-op
+METRICS_ENV = 'VISTIER_METRICS'
+
+# histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+DESCRIPTIONS = {
+    "vistier_stage_seconds": "Time spent per scan stage",
+    "vistier_rpc_seconds": "RPC request latency per method, as seen by the caller",
+    "vistier_rpc_requests_total": "RPC requests per method and outcome",
+    "vistier_cache_requests_total": "Cache lookups per cache and result",
+    "vistier_transactions_parsed_total": "Marketplace transactions parsed per marketplace and type",
+    "vistier_escrow_transactions_total": "Wallet transactions replayed by the history escrow scan",
+    "vistier_transaction_parse_seconds": "Time spent parsing a marketplace transaction",
+    "vistier_fee_calculation_seconds": "Time spent calculating the fees of a sale",
+}
+
+_enabled = None
+_lock = threading.Lock()
+# (name, labels) -> value
+_counters = dict()
+# (name, labels) -> [count per bucket..., count, sum]
+_histograms = dict()
+
+# spans of the request being traced, shared by the tasks it spawns
+_trace = contextvars.ContextVar("vistier_trace", default=None)
+
+
+def is_enabled() -> bool:
+    # read lazily so that it can be configured (e.g. via .env) after import
+    global _enabled
+    if _enabled is None:
+        _enabled = os.environ.get(METRICS_ENV, "").lower() in ("1", "true", "yes")
+    return _enabled
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    if not is_enabled():
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    if not is_enabled():
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+                break
+        histogram[-2] += 1
+        histogram[-1] += value
+
+
+class _Span:
+    __slots__ = ("stage", "trace", "started")
+
+    def __init__(self, stage: str, trace: Optional[list]) -> None:
+        self.stage = stage
+        self.trace = trace
+        self.started = None
+
+    def __enter__(self) -> "_Span":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        elapsed = time.perf_counter() - self.started
+        observe("vistier_stage_seconds", elapsed, stage=self.stage)
+        if self.trace is not None:
+            self.trace.append({"stage": self.stage,
+                               "start": round(self.started - self.trace[0], 6),
+                               "seconds": round(elapsed, 6)})
+
+
+_NO_SPAN = nullcontext()
+
+
+def span(stage: str):
+    """
+    Times a stage: `with metrics.span("escrow_scan"): ...`. Also recorded in the trace of the current request, if any.
+    """
+    trace = _trace.get()
+    if trace is None and not is_enabled():
+        return _NO_SPAN
+    return _Span(stage, trace)
+
+
+def start_trace():
+    """
+    Starts recording the spans of the current request (and of the tasks it creates from now on).
+    :return: a token for stop_trace
+    """
+    # the first element is the reference time of the span start offsets
+    return _trace.set([time.perf_counter()])
+
+
+def stop_trace(token) -> List[dict]:
+    trace = _trace.get()
+    _trace.reset(token)
+    return sorted(trace[1:], key=lambda recorded_span: recorded_span["start"]) if trace else list()
+
+
+def _format_labels(labels, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _bucket_label(bound) -> str:
+    return f'le="{bound}"'
+
+
+def render() -> str:
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+
+    lines = list()
+    described = set()
+
+    def describe(name: str, metric_type: str) -> None:
+        if name in described:
+            return
+        described.add(name)
+        lines.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+    for (name, labels), value in counters:
+        describe(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), histogram in histograms:
+        describe(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, _bucket_label(bound))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, _bucket_label('+Inf'))} {histogram[-2]}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram[-2]}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]}")
+
+    return "\n".join(lines) + "\n"
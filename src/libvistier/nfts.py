@@ -1,81 +1,227 @@
 import json
 import struct
+import asyncio
 import base58
 import base64
 
-from typing import List
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional
 
 import solana
 from solana.rpc.api import PublicKey
-from solana.rpc.types import TokenAccountOpts
+from solana.rpc.types import DataSliceOpts, MemcmpOpts, TokenAccountOpts
+from solders.pubkey import Pubkey
+
+from . import metrics
+from .utils import chunks, get_logger
+from .caches import LRUCache, PdaCache, get_cache_path, record_lookups
+from .collection_index import get_collection_index, get_existing_collection_index
+from .scheduler import AdaptiveScheduler
+
+logger = get_logger("VistierAPI")
 
 
 METADATA_PROGRAM_ID = PublicKey('metaqbxxUerdq28cj1RbAWkYQm3ybzjb6a8bt518x1s')
+TOKEN_PROGRAM_ID = PublicKey("TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA")
 
+# getMultipleAccounts accepts at most 100 accounts per call
+MULTIPLE_ACCOUNTS_CHUNK_SIZE = 100
 
-# taken from Metaplex python library
-def unpack_metadata_account(data: bytes) -> dict:
-    assert(data[0] == 4)
-    i = 1
-    source_account = base58.b58encode(bytes(struct.unpack('<' + "B"*32, data[i:i+32])))
-    i += 32
-    mint_account = base58.b58encode(bytes(struct.unpack('<' + "B"*32, data[i:i+32])))
-    i += 32
-    name_len = struct.unpack('<I', data[i:i+4])[0]
-    i += 4
-    name = struct.unpack('<' + "B"*name_len, data[i:i+name_len])
-    i += name_len
-    symbol_len = struct.unpack('<I', data[i:i+4])[0]
-    i += 4
-    symbol = struct.unpack('<' + "B"*symbol_len, data[i:i+symbol_len])
-    i += symbol_len
-    uri_len = struct.unpack('<I', data[i:i+4])[0]
-    i += 4
-    uri = struct.unpack('<' + "B"*uri_len, data[i:i+uri_len])
-    i += uri_len
-    fee = struct.unpack('<h', data[i:i+2])[0]
-    i += 2
-    has_creator = data[i]
-    i += 1
-    creators = []
-    verified = []
-    share = []
-    if has_creator:
-        creator_len = struct.unpack('<I', data[i:i+4])[0]
+# in-process mint -> metadata PDA derivations to keep, the persistent store (if configured) is unbounded
+PDA_CACHE_SIZE = 100_000
+PDA_CACHE_FILE = "pdas.sqlite"
+
+# derivations are cheap (~20us), a process pool only pays off on large cold batches such as whole collections
+PDA_PROCESS_POOL_THRESHOLD = 5000
+
+_pda_cache = None
+
+# mint decimals never change, remember them for this many mints
+MINT_DECIMALS_CACHE_SIZE = 100_000
+
+_mint_decimals = LRUCache(MINT_DECIMALS_CACHE_SIZE)
+
+# mint -> first verified creator key (b"" if none) of wallet tokens missing from the collection indexes, so that
+# their metadata is only checked once
+UNINDEXED_CREATORS_CACHE_SIZE = 100_000
+
+_unindexed_creators = LRUCache(UNINDEXED_CREATORS_CACHE_SIZE)
+
+
+_KEY = 4
+_U32 = struct.Struct('<I')
+_FEE_AND_HAS_CREATOR = struct.Struct('<hB')
+_CREATOR_FLAGS = struct.Struct('<BB')
+_SALE_FLAGS = struct.Struct('<??')
+_PUBKEY_SIZE = 32
+
+# SPL token account layout: mint (32), owner (32), amount (u64), ... only the mint and amount are requested
+_TOKEN_ACCOUNT_AMOUNT_OFFSET = 64
+_TOKEN_ACCOUNT_AMOUNT = struct.Struct('<Q')
+_TOKEN_ACCOUNT_SLICE = DataSliceOpts(offset=0, length=_TOKEN_ACCOUNT_AMOUNT_OFFSET + _TOKEN_ACCOUNT_AMOUNT.size)
+
+# the Metaplex programs pad name, symbol and uri to their max lengths (32, 10, 200), which puts these fields at
+# fixed offsets in the metadata accounts of collection NFTs
+_METADATA_MINT_OFFSET = 33
+_METADATA_NAME_OFFSET = 69
+_METADATA_SELLER_FEE_OFFSET = 319
+_METADATA_FIRST_CREATOR_OFFSET = 326
+_U16 = struct.Struct('<H')
+_METADATA_MINT_SLICE = DataSliceOpts(offset=_METADATA_MINT_OFFSET, length=_PUBKEY_SIZE)
+_METADATA_INDEX_SLICE = DataSliceOpts(offset=_METADATA_MINT_OFFSET,
+                                      length=_METADATA_SELLER_FEE_OFFSET + _U16.size - _METADATA_MINT_OFFSET)
+
+# SPL mint layout: mint authority (COption<Pubkey>, 36), supply (u64), decimals (u8), ... only decimals are requested
+_MINT_DECIMALS_SLICE = DataSliceOpts(offset=44, length=1)
+
+
+def _encode_pubkey(key: memoryview) -> str:
+    # solders encodes in native code, several times faster than the pure python base58 package
+    return str(Pubkey.from_bytes(key.tobytes()))
+
+
+def _decode_string(raw: memoryview) -> str:
+    return str(raw, "utf-8").strip("\x00")
+
+
+class MetadataAccount:
+    """
+    Zero-copy view over a Metaplex metadata account (layout as in the Metaplex python library).
+    Offsets are resolved once at construction, strings and base58 pubkeys are only decoded when a caller reads them.
+    """
+
+    def __init__(self, data) -> None:
+        view = memoryview(data)
+        assert(view[0] == _KEY)
+        i = 1
+        self._update_authority = view[i:i + _PUBKEY_SIZE]
+        i += _PUBKEY_SIZE
+        self._mint = view[i:i + _PUBKEY_SIZE]
+        i += _PUBKEY_SIZE
+        name_len = _U32.unpack_from(view, i)[0]
         i += 4
-        for _ in range(creator_len):
-            creator = base58.b58encode(bytes(struct.unpack('<' + "B"*32, data[i:i+32])))
-            # creators.append(creator)
-            creators.append(creator.decode("utf8"))
-            i += 32
-            verified.append(data[i])
-            i += 1
-            share.append(data[i])
-            i += 1
-    primary_sale_happened = bool(data[i])
-    i += 1
-    is_mutable = bool(data[i])
-    metadata = {
-        "update_authority": source_account.decode("utf8"),
-        "mint": mint_account.decode("utf8"),
-        "data": {
-            "name": bytes(name).decode("utf-8").strip("\x00"),
-            "symbol": bytes(symbol).decode("utf-8").strip("\x00"),
-            "uri": bytes(uri).decode("utf-8").strip("\x00"),
-            "seller_fee_basis_points": fee,
-            "creators": creators,
-            "verified": verified,
-            "share": share,
-        },
-        "primary_sale_happened": primary_sale_happened,
-        "is_mutable": is_mutable,
-    }
-    return metadata
+        self._name = view[i:i + name_len]
+        i += name_len
+        symbol_len = _U32.unpack_from(view, i)[0]
+        i += 4
+        self._symbol = view[i:i + symbol_len]
+        i += symbol_len
+        uri_len = _U32.unpack_from(view, i)[0]
+        i += 4
+        self._uri = view[i:i + uri_len]
+        i += uri_len
+        self.seller_fee_basis_points, has_creator = _FEE_AND_HAS_CREATOR.unpack_from(view, i)
+        i += 3
+        self.creator_keys = []
+        self.verified = []
+        self.share = []
+        if has_creator:
+            creator_len = _U32.unpack_from(view, i)[0]
+            i += 4
+            for _ in range(creator_len):
+                self.creator_keys.append(view[i:i + _PUBKEY_SIZE])
+                i += _PUBKEY_SIZE
+                verified, share = _CREATOR_FLAGS.unpack_from(view, i)
+                self.verified.append(verified)
+                self.share.append(share)
+                i += 2
+        self.primary_sale_happened, self.is_mutable = _SALE_FLAGS.unpack_from(view, i)
+
+    @cached_property
+    def update_authority(self) -> str:
+        return _encode_pubkey(self._update_authority)
+
+    @cached_property
+    def mint(self) -> str:
+        return _encode_pubkey(self._mint)
+
+    @cached_property
+    def name(self) -> str:
+        return _decode_string(self._name)
+
+    @cached_property
+    def symbol(self) -> str:
+        return _decode_string(self._symbol)
+
+    @cached_property
+    def uri(self) -> str:
+        return _decode_string(self._uri)
+
+    @cached_property
+    def creators(self) -> List[str]:
+        return [_encode_pubkey(creator_key) for creator_key in self.creator_keys]
+
+    def to_dict(self) -> dict:
+        return {
+            "update_authority": self.update_authority,
+            "mint": self.mint,
+            "data": {
+                "name": self.name,
+                "symbol": self.symbol,
+                "uri": self.uri,
+                "seller_fee_basis_points": self.seller_fee_basis_points,
+                "creators": list(self.creators),
+                "verified": list(self.verified),
+                "share": list(self.share),
+            },
+            "primary_sale_happened": self.primary_sale_happened,
+            "is_mutable": self.is_mutable,
+        }
+
+
+def decode_many(buffers) -> List[Optional[MetadataAccount]]:
+    """
+    Decodes a batch of raw metadata account buffers. Empty or missing buffers are returned as None.
+    """
+    return [MetadataAccount(buffer) if buffer else None for buffer in buffers]
+
+
+def unpack_metadata_account(data: bytes) -> dict:
+    return MetadataAccount(data).to_dict()
+
+
+def _derive_nft_pda(mint_key: str) -> bytes:
+    return bytes(PublicKey.find_program_address([b'metadata', bytes(METADATA_PROGRAM_ID), bytes(PublicKey(mint_key))],
+                                                METADATA_PROGRAM_ID)[0])
+
+
+def _get_pda_cache() -> PdaCache:
+    # created lazily so that the cache location can be configured (e.g. via .env) after import
+    global _pda_cache
+    if _pda_cache is None:
+        _pda_cache = PdaCache(max_size=PDA_CACHE_SIZE, path=get_cache_path(PDA_CACHE_FILE))
+    return _pda_cache
+
+
+def derive_pdas(mint_keys: List[str], processes: Optional[int] = None) -> List[PublicKey]:
+    """
+    Returns the metadata PDA of each mint, aligned with mint_keys. Already known derivations are served from the
+    PDA cache; cold batches of at least PDA_PROCESS_POOL_THRESHOLD mints are derived in a process pool.
+    :param mint_keys: NFT mint addresses
+    :param processes: number of processes to derive cold batches with, 1 disables the pool. Default is CPU count
+    """
+    # callers may also pass PublicKey/Pubkey mints, the cache is keyed by the address string
+    mint_keys = [str(mint_key) for mint_key in mint_keys]
+    pda_cache = _get_pda_cache()
+    known = pda_cache.get_many(mint_keys)
+    missing = [mint_key for mint_key in dict.fromkeys(mint_keys) if mint_key not in known]
+
+    if missing:
+        if processes != 1 and len(missing) >= PDA_PROCESS_POOL_THRESHOLD:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                derived = list(executor.map(_derive_nft_pda, missing, chunksize=256))
+        else:
+            derived = [_derive_nft_pda(mint_key) for mint_key in missing]
+        derived = dict(zip(missing, derived))
+        pda_cache.put_many(derived)
+        known.update(derived)
+
+    return [PublicKey(known[mint_key]) for mint_key in mint_keys]
 
 
 def get_nft_pda(mint_key: str) -> PublicKey:
-    return PublicKey.find_program_address([b'metadata', bytes(METADATA_PROGRAM_ID), bytes(PublicKey(mint_key))],
-                                          METADATA_PROGRAM_ID)[0]
+    return derive_pdas([mint_key])[0]
 
 
 def get_metadata(solana_client, mint_address: str) -> dict:
@@ -121,38 +267,333 @@ def get_tokens_held_by_address(solana_client: solana.rpc.api.Client, public_key:
     return json.loads(result.to_json())
 
 
-def find_nfts_of_collection(solana_client: solana.rpc.api.Client,
-                            mint_addresses: list,
-                            collection_candy_machin_ids: List[str]) -> List[dict]:
-    nfts = list()
+def _decode_metadata_accounts(accounts) -> List[Optional[MetadataAccount]]:
+    return decode_many([account.data if account is not None else None for account in accounts])
+
+
+def get_metadata_batch(solana_client: solana.rpc.api.Client,
+                       mint_addresses: List[str]) -> List[Optional[MetadataAccount]]:
+    """
+    Batched version of get_metadata. Derives all metadata PDAs and fetches them, in chunks, via getMultipleAccounts.
+    Returns a list of lazily decoded MetadataAccount views aligned with mint_addresses, holding None where no
+    metadata account exists.
+    """
+    pdas = derive_pdas(mint_addresses)
+    accounts = list()
+    for pda_chunk in chunks(pdas, MULTIPLE_ACCOUNTS_CHUNK_SIZE):
+        accounts += solana_client.get_multiple_accounts(pda_chunk).value
+    return _decode_metadata_accounts(accounts)
+
+
+async def _rpc_call(scheduler: Optional[AdaptiveScheduler], factory):
+    if scheduler is None:
+        return await factory()
+    return await scheduler.call(factory)
+
+
+def _forget_failed_fetch(metadata_memo: dict, mint_addresses: List[str], fetch: asyncio.Future) -> None:
+    if not fetch.cancelled() and fetch.exception() is None:
+        return
+    # later callers fetch these mints again instead of sharing the failure
+    for mint in mint_addresses:
+        if metadata_memo.get(mint, (None, None))[0] is fetch:
+            del metadata_memo[mint]
+
+
+async def get_metadata_batch_async(solana_client, mint_addresses: List[str],
+                                   metadata_memo: Optional[dict] = None,
+                                   scheduler: Optional[AdaptiveScheduler] = None) -> List[Optional[MetadataAccount]]:
+    """
+    Same as get_metadata_batch but uses an async client and queries all chunks concurrently.
+    :param metadata_memo: optional dict shared by concurrent callers (e.g. the wallets of a batch), so that each mint
+    is only fetched once, even while the first fetch is still in flight. Failed fetches are dropped from it
+    :param scheduler: if given, the RPC calls run under its concurrency limit and are retried by it
+    """
+    if metadata_memo is None:
+        return await _fetch_metadata_batch_async(solana_client, mint_addresses, scheduler)
+
+    to_fetch = list(dict.fromkeys(mint for mint in mint_addresses if mint not in metadata_memo))
+    if to_fetch:
+        fetch = asyncio.ensure_future(_fetch_metadata_batch_async(solana_client, to_fetch, scheduler))
+        for position, mint in enumerate(to_fetch):
+            metadata_memo[mint] = (fetch, position)
+        fetch.add_done_callback(lambda done: _forget_failed_fetch(metadata_memo, to_fetch, done))
+
+    metadata_list = list()
+    for mint in mint_addresses:
+        fetch, position = metadata_memo[mint]
+        # shared with other callers, cancelling this one must not cancel the fetch
+        metadata_list.append((await asyncio.shield(fetch))[position])
+    return metadata_list
+
+
+async def _fetch_metadata_batch_async(solana_client, mint_addresses: List[str],
+                                      scheduler: Optional[AdaptiveScheduler] = None) -> List[Optional[MetadataAccount]]:
+    with metrics.span("pda_derivation"):
+        if len(mint_addresses) >= PDA_PROCESS_POOL_THRESHOLD:
+            # large cold batches take seconds to derive, keep the event loop serving other requests meanwhile
+            pdas = await asyncio.get_running_loop().run_in_executor(None, derive_pdas, mint_addresses)
+        else:
+            pdas = derive_pdas(mint_addresses)
+    with metrics.span("metadata_fetch"):
+        responses = await asyncio.gather(*[
+            _rpc_call(scheduler, lambda pda_chunk=pda_chunk: solana_client.get_multiple_accounts(pda_chunk))
+            for pda_chunk in chunks(pdas, MULTIPLE_ACCOUNTS_CHUNK_SIZE)
+        ])
+    accounts = list()
+    for response in responses:
+        accounts += response.value
+    return _decode_metadata_accounts(accounts)
+
 
-    for nft_mint_address in mint_addresses:
-        metadata = get_metadata(solana_client, nft_mint_address)
-        if not metadata or not metadata.get('data'):
+def _decode_candy_machine_ids(collection_candy_machin_ids: List[str]) -> set:
+    decoded_ids = set()
+    for candy_machine_id in collection_candy_machin_ids:
+        try:
+            decoded_ids.add(base58.b58decode(candy_machine_id))
+        except ValueError:
+            # not a valid base58 key, it could never match a creator anyway
             continue
+    return decoded_ids
 
-        creators = metadata['data']['creators']
-        verified = metadata['data']['verified']
 
-        if not verified or verified[0] != 1:
+def filter_collection_nfts(metadata_list: List[Optional[MetadataAccount]],
+                           collection_candy_machin_ids: List[str]) -> List[dict]:
+    nfts = list()
+    candy_machine_keys = _decode_candy_machine_ids(collection_candy_machin_ids)
+
+    for metadata in metadata_list:
+        if not metadata:
+            continue
+
+        if not metadata.verified or metadata.verified[0] != 1:
             # NFT collection is not verified by indicated creator wallet, can be a scam!
             continue
 
-        if not creators:
+        if not metadata.creator_keys:
             continue
 
-        if creators[0] in collection_candy_machin_ids:
-            nfts.append(metadata)
+        # compare raw keys so that base58 is only computed for NFTs that are actually returned
+        if metadata.creator_keys[0].tobytes() in candy_machine_keys:
+            nfts.append(metadata.to_dict())
 
     return nfts
 
 
-def find_wallet_nfts(solana_client: solana.rpc.api.Client,
-                     wallet_address: str,
-                     collection_candy_machin_ids: List[str]) -> List[dict]:
+def _decode_index_record(data) -> tuple:
+    # data is sliced with _METADATA_INDEX_SLICE
+    view = memoryview(data)
+    name_offset = _METADATA_NAME_OFFSET - _METADATA_MINT_OFFSET
+    return view[:_PUBKEY_SIZE].tobytes(), (
+        view[name_offset:name_offset + _PUBKEY_SIZE].tobytes(),
+        _U16.unpack_from(view, _METADATA_SELLER_FEE_OFFSET - _METADATA_MINT_OFFSET)[0]
+    )
 
-    opts = TokenAccountOpts(program_id=PublicKey("TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA"))
-    result = solana_client.get_token_accounts_by_owner_json_parsed(PublicKey(wallet_address), opts)
+
+def refresh_collection_index(solana_client: solana.rpc.api.Client, candy_machine_id: str) -> int:
+    """
+    Builds or updates the collection index of the candy machine id: all metadata accounts whose first creator is the
+    (verified) candy machine, found with a single getProgramAccounts call. Once built, refreshes only list the mints
+    and fetch the records of the new ones.
+    :return: the number of mints added to the index
+    """
+    index = get_collection_index(candy_machine_id)
+    # first creator key followed by its verified flag
+    creator_filter = MemcmpOpts(offset=_METADATA_FIRST_CREATOR_OFFSET,
+                                bytes=base58.b58encode(bytes(Pubkey.from_string(candy_machine_id)) + b"\x01").decode())
+    records = index.records()
+
+    if not records:
+        accounts = solana_client.get_program_accounts(METADATA_PROGRAM_ID, encoding="base64",
+                                                      data_slice=_METADATA_INDEX_SLICE, filters=[creator_filter]).value
+        records = dict(_decode_index_record(keyed_account.account.data) for keyed_account in accounts)
+        added = len(records)
+        _forget_unindexed_creators(str(Pubkey.from_bytes(mint_key)) for mint_key in records)
+    else:
+        accounts = solana_client.get_program_accounts(METADATA_PROGRAM_ID, encoding="base64",
+                                                      data_slice=_METADATA_MINT_SLICE, filters=[creator_filter]).value
+        current_mint_keys = {bytes(keyed_account.account.data) for keyed_account in accounts}
+        new_mints = [str(Pubkey.from_bytes(mint_key)) for mint_key in current_mint_keys if mint_key not in records]
+        # burned NFTs leave the collection
+        records = {mint_key: record for mint_key, record in records.items() if mint_key in current_mint_keys}
+        added = 0
+        for pda_chunk in chunks(derive_pdas(new_mints), MULTIPLE_ACCOUNTS_CHUNK_SIZE):
+            for account in solana_client.get_multiple_accounts(pda_chunk, data_slice=_METADATA_INDEX_SLICE).value:
+                if account is not None:
+                    mint_key, record = _decode_index_record(account.data)
+                    records[mint_key] = record
+                    added += 1
+        _forget_unindexed_creators(new_mints)
+
+    index.write(records)
+    logger.info("Collection index of %s has %d NFTs, %d new", candy_machine_id, len(records), added)
+    return added
+
+
+def _indexed_collection_members(mint_addresses: list, collection_candy_machin_ids: List[str]) -> list:
+    """
+    Drops the mints that are known not to be part of the collections, before any metadata is fetched.
+    Unless every candy machine id is indexed, all mints are kept.
+    A mint missing from the indexes may still be a member: minted after the last refresh, or with metadata whose
+    strings are not padded (the index query matches the first creator at a fixed offset). Those mints are kept until
+    their metadata was checked once, from then on their cached first creator decides.
+    """
+    indexes = [get_existing_collection_index(candy_machine_id) for candy_machine_id in collection_candy_machin_ids]
+    if not indexes or None in indexes:
+        return mint_addresses
+
+    candy_machine_keys = _decode_candy_machine_ids(collection_candy_machin_ids)
+    mint_keys = [bytes(Pubkey.from_string(mint_address)) for mint_address in mint_addresses]
+    membership = [index.contains_many(mint_keys) for index in indexes]
+    members = list()
+    unchecked = 0
+    for mint_address, *is_member in zip(mint_addresses, *membership):
+        if any(is_member):
+            members.append(mint_address)
+            continue
+        first_creator = _unindexed_creators.get(mint_address)
+        if first_creator is None:
+            unchecked += 1
+            members.append(mint_address)
+        elif first_creator in candy_machine_keys:
+            members.append(mint_address)
+    if unchecked:
+        logger.debug("%d of %d wallet tokens are not in the collection indexes, checking their metadata",
+                     unchecked, len(mint_addresses))
+    return members
+
+
+def _remember_unindexed_creators(mint_addresses: list, metadata_list: List[Optional[MetadataAccount]]) -> None:
+    for mint_address, metadata in zip(mint_addresses, metadata_list):
+        first_creator = b""
+        if metadata and metadata.creator_keys and metadata.verified[0] == 1:
+            first_creator = metadata.creator_keys[0].tobytes()
+        _unindexed_creators.put(mint_address, first_creator)
+
+
+def _forget_unindexed_creators(mint_addresses: Iterable[str]) -> None:
+    # mints that made it into an index are answered by it, their cached first creator is of no use anymore
+    if not len(_unindexed_creators):
+        return
+    for mint_address in mint_addresses:
+        _unindexed_creators.pop(mint_address)
+
+
+def find_nfts_of_collection(solana_client: solana.rpc.api.Client,
+                            mint_addresses: list,
+                            collection_candy_machin_ids: List[str]) -> List[dict]:
+    mint_addresses = _indexed_collection_members(mint_addresses, collection_candy_machin_ids)
+    metadata_list = get_metadata_batch(solana_client, mint_addresses)
+    _remember_unindexed_creators(mint_addresses, metadata_list)
+    return filter_collection_nfts(metadata_list, collection_candy_machin_ids)
+
+
+async def find_nfts_of_collection_async(solana_client,
+                                        mint_addresses: list,
+                                        collection_candy_machin_ids: List[str],
+                                        metadata_memo: Optional[dict] = None,
+                                        scheduler: Optional[AdaptiveScheduler] = None) -> List[dict]:
+    mint_addresses = _indexed_collection_members(mint_addresses, collection_candy_machin_ids)
+    metadata_list = await get_metadata_batch_async(solana_client, mint_addresses, metadata_memo, scheduler)
+    _remember_unindexed_creators(mint_addresses, metadata_list)
+    return filter_collection_nfts(metadata_list, collection_candy_machin_ids)
+
+
+def _decode_single_token_mints(keyed_accounts) -> List[str]:
+    """
+    Mints of the token accounts (sliced to mint and amount) holding exactly one token.
+    """
+    mints = list()
+    for keyed_account in keyed_accounts:
+        view = memoryview(keyed_account.account.data)
+        if len(view) < _TOKEN_ACCOUNT_SLICE.length:
+            continue
+        if _TOKEN_ACCOUNT_AMOUNT.unpack_from(view, _TOKEN_ACCOUNT_AMOUNT_OFFSET)[0] != 1:
+            continue
+        mints.append(_encode_pubkey(view[:_PUBKEY_SIZE]))
+    return mints
+
+
+def _cached_mint_decimals(mints: List[str]) -> tuple:
+    decimals = dict()
+    to_fetch = list()
+    for mint in mints:
+        mint_decimals = _mint_decimals.get(mint)
+        if mint_decimals is None:
+            to_fetch.append(mint)
+        else:
+            decimals[mint] = mint_decimals
+    record_lookups("mint_decimals", len(decimals), len(decimals) + len(to_fetch))
+    return decimals, to_fetch
+
+
+def _store_mint_decimals(decimals: dict, mint_chunk: List[str], accounts) -> None:
+    for mint, account in zip(mint_chunk, accounts):
+        if account is None or not account.data:
+            continue
+        decimals[mint] = account.data[0]
+        _mint_decimals.put(mint, account.data[0])
+
+
+def get_mint_decimals(solana_client: solana.rpc.api.Client, mints: List[str]) -> dict:
+    """
+    mint -> decimals, fetching only the decimals byte of the mints not already cached. Unknown mints are left out.
+    """
+    decimals, to_fetch = _cached_mint_decimals(mints)
+    for mint_chunk in chunks(to_fetch, MULTIPLE_ACCOUNTS_CHUNK_SIZE):
+        accounts = solana_client.get_multiple_accounts([PublicKey(mint) for mint in mint_chunk],
+                                                       data_slice=_MINT_DECIMALS_SLICE).value
+        _store_mint_decimals(decimals, mint_chunk, accounts)
+    return decimals
+
+
+async def get_mint_decimals_async(solana_client, mints: List[str],
+                                  scheduler: Optional[AdaptiveScheduler] = None) -> dict:
+    """
+    Same as get_mint_decimals but uses an async client and queries all chunks concurrently.
+    """
+    decimals, to_fetch = _cached_mint_decimals(mints)
+    mint_chunks = list(chunks(to_fetch, MULTIPLE_ACCOUNTS_CHUNK_SIZE))
+    responses = await asyncio.gather(*[
+        _rpc_call(scheduler, lambda mint_chunk=mint_chunk: solana_client.get_multiple_accounts(
+            [PublicKey(mint) for mint in mint_chunk], data_slice=_MINT_DECIMALS_SLICE))
+        for mint_chunk in mint_chunks
+    ])
+    for mint_chunk, response in zip(mint_chunks, responses):
+        _store_mint_decimals(decimals, mint_chunk, response.value)
+    return decimals
+
+
+def _binary_token_accounts_opts() -> TokenAccountOpts:
+    return TokenAccountOpts(program_id=TOKEN_PROGRAM_ID, encoding="base64", data_slice=_TOKEN_ACCOUNT_SLICE)
+
+
+def find_wallet_nft_mints_binary(solana_client: solana.rpc.api.Client, wallet_address: str) -> List[str]:
+    """
+    Same selection as the json parsed scan of find_wallet_nfts, from base64 token accounts cut down to the mint and
+    amount (72 of 165 bytes). Decimals live in the mint accounts, they are fetched (1 byte each) only for
+    the accounts holding a single token.
+    """
+    result = solana_client.get_token_accounts_by_owner(PublicKey(wallet_address), _binary_token_accounts_opts())
+    single_token_mints = _decode_single_token_mints(result.value)
+
+    # https://docs.metaplex.com/programs/token-metadata/overview
+    decimals = get_mint_decimals(solana_client, single_token_mints)
+    return [mint for mint in single_token_mints if decimals.get(mint) == 0]
+
+
+async def find_wallet_nft_mints_binary_async(solana_client, wallet_address: str,
+                                             scheduler: Optional[AdaptiveScheduler] = None) -> List[str]:
+    result = await _rpc_call(scheduler, lambda: solana_client.get_token_accounts_by_owner(
+        PublicKey(wallet_address), _binary_token_accounts_opts()))
+    single_token_mints = _decode_single_token_mints(result.value)
+
+    # https://docs.metaplex.com/programs/token-metadata/overview
+    decimals = await get_mint_decimals_async(solana_client, single_token_mints, scheduler)
+    return [mint for mint in single_token_mints if decimals.get(mint) == 0]
+
+
+def _select_parsed_nft_mints(result) -> List[str]:
     payload = json.loads(result.to_json())
     possible_nfts = list()
 
@@ -167,9 +608,41 @@ def find_wallet_nfts(solana_client: solana.rpc.api.Client,
 
         possible_nfts.append(token_data)
 
-    return find_nfts_of_collection(
-        solana_client,
-        [token_data['account']['data']['parsed']['info']['mint'] for token_data in possible_nfts],
-        collection_candy_machin_ids
-    )
+    return [token_data['account']['data']['parsed']['info']['mint'] for token_data in possible_nfts]
+
+
+def find_wallet_nfts(solana_client: solana.rpc.api.Client,
+                     wallet_address: str,
+                     collection_candy_machin_ids: List[str],
+                     binary_scan: bool = False) -> List[dict]:
+
+    if binary_scan:
+        mint_addresses = find_wallet_nft_mints_binary(solana_client, wallet_address)
+    else:
+        result = solana_client.get_token_accounts_by_owner_json_parsed(PublicKey(wallet_address),
+                                                                       TokenAccountOpts(program_id=TOKEN_PROGRAM_ID))
+        mint_addresses = _select_parsed_nft_mints(result)
+
+    return find_nfts_of_collection(solana_client, mint_addresses, collection_candy_machin_ids)
+
+
+async def find_wallet_nfts_async(solana_client,
+                                 wallet_address: str,
+                                 collection_candy_machin_ids: List[str],
+                                 binary_scan: bool = False,
+                                 metadata_memo: Optional[dict] = None,
+                                 scheduler: Optional[AdaptiveScheduler] = None) -> List[dict]:
+    """
+    Same as find_wallet_nfts but uses an async client, never blocking the event loop on RPC calls.
+    See get_metadata_batch_async for metadata_memo and scheduler.
+    """
+    with metrics.span("wallet_token_scan"):
+        if binary_scan:
+            mint_addresses = await find_wallet_nft_mints_binary_async(solana_client, wallet_address, scheduler)
+        else:
+            result = await _rpc_call(scheduler, lambda: solana_client.get_token_accounts_by_owner_json_parsed(
+                PublicKey(wallet_address), TokenAccountOpts(program_id=TOKEN_PROGRAM_ID)))
+            mint_addresses = _select_parsed_nft_mints(result)
 
+    return await find_nfts_of_collection_async(solana_client, mint_addresses, collection_candy_machin_ids,
+                                               metadata_memo, scheduler)
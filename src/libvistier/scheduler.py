@@ -0,0 +1,189 @@
+import time
+import random
+import asyncio
+import threading
+
+from collections import deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+
+from .utils import get_logger
+
+logger = get_logger("VistierAPI")
+
+T = TypeVar("T")
+
+# latencies of the RPC requests sent by the scheduled call running in the current task
+_rpc_latencies: ContextVar = ContextVar("rpc_latencies", default=None)
+
+
+def record_rpc_latency(latency: float) -> None:
+    """
+    Called by the RPC providers for each request answered, so that the scheduler only judges the endpoint by
+    actual round trips and not by calls answered from a cache.
+    """
+    latencies = _rpc_latencies.get()
+    if latencies is not None:
+        latencies.append(latency)
+
+
+def is_retryable(exception: BaseException) -> bool:
+    """
+    True if the exception (or one it was raised from) is the RPC endpoint throttling us (429),
+    failing server side (5xx) or the connection to it failing.
+    """
+    while exception is not None:
+        if isinstance(exception, httpx.HTTPStatusError):
+            status_code = exception.response.status_code
+            return status_code == 429 or status_code >= 500
+        if isinstance(exception, httpx.TransportError):
+            return True
+        exception = exception.__cause__ or exception.__context__
+    return False
+
+
+class AdaptiveScheduler:
+    """
+    Runs RPC calls under an in-flight limit that adapts to how the endpoint behaves (AIMD): the limit grows by one
+    per window of successful calls (doubling per round trip until the first congestion) and is cut by
+    DECREASE_FACTOR when the endpoint throttles, errors or its latency degrades.
+    Throttled and failed calls are retried with jittered backoff.
+    Callers wait for a free slot in FIFO order, so a slow call never holds up more than its own slot.
+    A scheduler can be shared by callers running on different event loops (threads), e.g. all requests of the process.
+    """
+
+    DECREASE_FACTOR = 0.5
+    # a call slower than this many times the best observed latency counts as congestion
+    LATENCY_TOLERANCE = 4
+    # smoothing of the latency average
+    LATENCY_EWMA_WEIGHT = 0.2
+    BASE_BACKOFF = 0.25
+    MAX_BACKOFF = 10
+
+    def __init__(self, initial_limit: int, max_limit: int, max_retries: int, min_limit: int = 1) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.max_retries = max_retries
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # (loop, future) of the callers waiting for a slot
+        self._waiters = deque()
+        self._min_latency = None
+        self._avg_latency = None
+        self._last_decrease = 0.0
+        # like TCP slow start, the limit doubles every round trip until the endpoint first shows congestion
+        self._slow_start = True
+
+        self.calls = 0
+        self.retries = 0
+
+    async def call(self, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        Runs factory() once a slot is free, retrying it while it fails with a retryable error.
+        :param factory: returns a new awaitable for each attempt, e.g. lambda: client.get_transaction(sig)
+        """
+        attempt = 0
+        while True:
+            await self._acquire()
+            latencies = list()
+            token = _rpc_latencies.set(latencies)
+            try:
+                result = await factory()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                self._decrease()
+            else:
+                # a call served from cache (no request sent) says nothing about the endpoint
+                self._on_success(max(latencies) if latencies else None)
+                return result
+            finally:
+                _rpc_latencies.reset(token)
+                # also reached when the caller is cancelled, the slot must never leak
+                self._release()
+
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+            await asyncio.sleep(self._backoff(attempt))
+
+    async def _acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._in_flight < int(self.limit):
+                self._in_flight += 1
+                return
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over right before the cancellation, give it back
+                self._release()
+            raise
+
+    def _grant(self, waiter: asyncio.Future) -> None:
+        # runs on the loop of the waiter
+        if waiter.done():
+            # cancelled while the slot was being handed over
+            self._release()
+        else:
+            waiter.set_result(None)
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        # called with the lock held
+        while self._waiters and self._in_flight < int(self.limit):
+            loop, waiter = self._waiters.popleft()
+            if waiter.done() or loop.is_closed():
+                continue
+            self._in_flight += 1
+            loop.call_soon_threadsafe(self._grant, waiter)
+
+    def _on_success(self, latency: Optional[float]) -> None:
+        with self._lock:
+            self.calls += 1
+            if latency is None:
+                return
+            if self._min_latency is None:
+                self._min_latency = self._avg_latency = latency
+            self._min_latency = min(self._min_latency, latency)
+            self._avg_latency += self.LATENCY_EWMA_WEIGHT * (latency - self._avg_latency)
+
+            if self._avg_latency > self._min_latency * self.LATENCY_TOLERANCE:
+                self._decrease_locked()
+            elif self._slow_start:
+                self.limit = min(self.max_limit, self.limit + 1)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake_waiters()
+
+    def _decrease(self) -> None:
+        with self._lock:
+            self._decrease_locked()
+
+    def _decrease_locked(self) -> None:
+        # calls failing together are one congestion event, only react once per round trip
+        now = time.monotonic()
+        if now - self._last_decrease < (self._avg_latency or 0):
+            return
+        self._last_decrease = now
+        self._slow_start = False
+        self.limit = max(self.min_limit, self.limit * self.DECREASE_FACTOR)
+        if self._avg_latency is not None:
+            # forget the degraded latency, it would otherwise keep the limit down after the endpoint recovered
+            self._avg_latency = self._min_latency
+        logger.warning("RPC endpoint congested, reducing in-flight requests limit to %d", self.limit)
+
+    def _backoff(self, attempt: int) -> float:
+        # "full jitter" exponential backoff
+        return random.uniform(0, min(self.MAX_BACKOFF, self.BASE_BACKOFF * 2 ** attempt))
@@ -1,5 +1,6 @@
+import math
 import asyncio
-import traceback
+from collections import deque
 from typing import List
 from datetime import datetime
 
@@ -8,78 +9,214 @@ from solders.rpc.responses import GetTransactionResp
 from solders.signature import Signature
 
 from . import marketplace
+from . import metrics
+from .caches import LastSaleIndex, get_cache_path
 from .clients import get_async_client
-from .utils import split, get_logger
+from .transactions import get_transaction
+from .scheduler import AdaptiveScheduler
+from .utils import get_logger, log_tx_sampled, gather_or_cancel, cancel_tasks
 
 logger = get_logger("VistierAPI")
 
+# bounds and starting value of how many of an NFT's transactions are fetched ahead while looking for its last sale
+MIN_PREFETCH_WINDOW = 2
+DEFAULT_PREFETCH_WINDOW = 4
+MAX_PREFETCH_WINDOW = 32
+
+# smoothing of the per collection average depth (in transactions) at which the last sale is found
+SALE_DEPTH_EWMA_WEIGHT = 0.2
+
+# collection (treasuries) -> average depth of the last sale, drives the prefetch window
+_sale_depths = dict()
+
+LAST_SALE_INDEX_FILE = "last_sales.sqlite"
+
+_last_sale_index = None
+
+
+def get_last_sale_index() -> LastSaleIndex:
+    # created lazily so that the index location can be configured (e.g. via .env) after import
+    global _last_sale_index
+    if _last_sale_index is None:
+        _last_sale_index = LastSaleIndex(path=get_cache_path(LAST_SALE_INDEX_FILE))
+    return _last_sale_index
+
 
 async def get_sale(solana_client, tx_sig: Signature, nft_treasuries: List[str]):
-    tx_response: GetTransactionResp = await solana_client.get_transaction(tx_sig=tx_sig)
+    tx_response: GetTransactionResp = await get_transaction(solana_client, tx_sig)
     if not tx_response.value:
         return
-    transaction = tx_response.value.transaction
 
-    if not marketplace.is_marketplace(transaction.transaction.message.account_keys):
-        return
-
-    if marketplace.MagicEdenTransaction.is_marketplace_tx(transaction):
-        marketplace_transaction = marketplace.MagicEdenTransaction(tx_response)
-        if marketplace_transaction.is_sale():
-            marketplace_transaction.calculate_fees(nft_treasuries)
-            return marketplace_transaction
+    marketplace_transaction = marketplace.parse_transaction(tx_response, nft_treasuries)
+    if marketplace_transaction is not None and marketplace_transaction.is_sale():
+        # the sale fields are all that is needed from now on, the decoded transaction can be released
+        return marketplace.SaleRecord.from_transaction(marketplace_transaction)
     return
 
 
-async def _get_nft_last_sale(nft_batch, index_base, nft_treasuries: List[str], tx_cnt_to_check, max_tx_cnt_to_check):
-    solana_client = await get_async_client()
-    query_chunk_size = min(max_tx_cnt_to_check, tx_cnt_to_check)
+def _collection_key(nft_treasuries: List[str]) -> tuple:
+    return tuple(sorted(nft_treasuries))
+
+
+def _prefetch_window(collection_key: tuple) -> int:
+    depth = _sale_depths.get(collection_key)
+    if depth is None:
+        return DEFAULT_PREFETCH_WINDOW
+    # cover the usual depth with some margin, so that the sale is most often already fetched when reached
+    return max(MIN_PREFETCH_WINDOW, min(MAX_PREFETCH_WINDOW, math.ceil(depth * 1.5)))
+
+
+def _record_sale_depth(collection_key: tuple, depth: int) -> None:
+    previous_depth = _sale_depths.get(collection_key)
+    if previous_depth is None:
+        _sale_depths[collection_key] = depth
+    else:
+        _sale_depths[collection_key] = previous_depth + SALE_DEPTH_EWMA_WEIGHT * (depth - previous_depth)
 
-    nft_sell_txs = list()
 
-    for nft_index, nft_mint_address in enumerate(nft_batch):
-        signature_batch = await solana_client.get_signatures_for_address(PublicKey(nft_mint_address),
-                                                                         limit=query_chunk_size)
-        for index, confirmed_transaction in enumerate(signature_batch.value):
-            block_time = datetime.fromtimestamp(confirmed_transaction.block_time)
+async def _get_nft_last_sale(solana_client, scheduler: AdaptiveScheduler, nft_index, nft_mint_address,
+                             nft_treasuries: List[str], tx_cnt_to_check, max_tx_cnt_to_check):
+    with metrics.span("nft_sale_scan"):
+        return await _scan_nft_last_sale(solana_client, scheduler, nft_index, nft_mint_address, nft_treasuries,
+                                         tx_cnt_to_check, max_tx_cnt_to_check)
+
+
+async def _scan_nft_last_sale(solana_client, scheduler: AdaptiveScheduler, nft_index, nft_mint_address,
+                              nft_treasuries: List[str], tx_cnt_to_check, max_tx_cnt_to_check):
+    query_chunk_size = min(max_tx_cnt_to_check, tx_cnt_to_check)
+
+    # a sale older than the newest signature checked by a previous query is already known,
+    # only the transactions that came after it need to be looked at
+    last_sale_index = get_last_sale_index()
+    indexed = last_sale_index.get(nft_mint_address)
+    checkpoint = Signature.from_string(indexed[0]) if indexed else None
+
+    signature_batch = await scheduler.call(lambda: solana_client.get_signatures_for_address(
+        PublicKey(nft_mint_address), limit=query_chunk_size, until=checkpoint))
+    signatures = signature_batch.value
+    if indexed:
+        logger.info("NFT %s was indexed, checking %d newer transactions", nft_index, len(signatures))
+
+    sale_tx, complete = await _find_newest_sale(solana_client, scheduler, nft_index, signatures, nft_treasuries)
+    # a full page may not reach the checkpoint (or the start of the history): the transactions past it were not
+    # checked, so without a sale in the page nothing is known about the last sale. The checkpoint stays where it is
+    # and the gap is checked by a later query that reaches it
+    reached_end = len(signatures) < query_chunk_size
+    if complete and sale_tx is None and signatures and not reached_end:
+        # the page may end exactly at the checkpoint, in which case nothing is left between the two
+        remaining_batch = await scheduler.call(lambda: solana_client.get_signatures_for_address(
+            PublicKey(nft_mint_address), limit=1, before=signatures[-1].signature, until=checkpoint))
+        reached_end = not remaining_batch.value
+    # if a transaction could not be checked it may have been a newer sale, the checkpoint must not move past it
+    if complete and signatures and (sale_tx or reached_end):
+        indexed_sale = sale_tx.to_dict() if sale_tx else indexed[1] if indexed else None
+        last_sale_index.put(nft_mint_address, str(signatures[0].signature), indexed_sale)
+
+    if sale_tx is None and reached_end and indexed and indexed[1]:
+        logger.info("Found indexed sale for NFT %s", nft_index)
+        return marketplace.SaleRecord(indexed[1])
+    return sale_tx
+
+
+async def _find_newest_sale(solana_client, scheduler: AdaptiveScheduler, nft_index, signatures,
+                            nft_treasuries: List[str]):
+    """
+    Checks the signatures in order (newest first) for a sale.
+    :return: the sale (or None) and whether all transactions up to it could be checked
+    """
+    # the next prefetch_window transactions are kept in flight and consumed in order (newest first)
+    collection_key = _collection_key(nft_treasuries)
+    prefetch_window = _prefetch_window(collection_key)
+    in_flight = deque()
+    next_to_fetch = 0
+    incomplete = False
+
+    try:
+        for index, confirmed_transaction in enumerate(signatures):
+            while next_to_fetch < len(signatures) and len(in_flight) < prefetch_window:
+                signature_to_fetch = signatures[next_to_fetch].signature
+                in_flight.append(asyncio.ensure_future(scheduler.call(
+                    lambda tx_sig=signature_to_fetch: get_sale(solana_client, tx_sig, nft_treasuries))))
+                next_to_fetch += 1
 
             signature = confirmed_transaction.signature
 
-            logger.info(f"Processing NFT {index_base + nft_index} tx #{index + 1} tx:{signature} from {block_time}")
+            if log_tx_sampled(index):
+                logger.info("Processing NFT %s tx #%d tx:%s from %s", nft_index, index + 1, signature,
+                            datetime.fromtimestamp(confirmed_transaction.block_time))
             try:
-                sale_tx = await get_sale(solana_client, signature, nft_treasuries)
+                sale_tx = await in_flight.popleft()
                 if sale_tx:
-                    nft_sell_txs.append(sale_tx)
-                    logger.info(f"Found sale for NFT {index_base + nft_index}")
-                    break
+                    logger.info("Found sale for NFT %s", nft_index)
+                    _record_sale_depth(collection_key, index + 1)
+                    return sale_tx, not incomplete
             except Exception:
-                logger.error(f"Error processing transaction: {signature}:{traceback.format_exc()}")
-    return nft_sell_txs
+                incomplete = True
+                logger.exception("Error processing transaction: %s", signature)
+        if signatures:
+            # no sale in the checked history, sales sit at least this deep
+            _record_sale_depth(collection_key, len(signatures))
+    finally:
+        # the newest sale is known (or the scan failed), older transactions are of no interest
+        cancel_tasks(in_flight)
+    return None, not incomplete
 
 
 async def get_nft_last_sale_batch(
-        owned_nfts, nft_treasuries, worker_count, tx_cnt_to_check_, max_tx_cnt_to_check, max_nfts_to_process
+        owned_nfts, nft_treasuries, tx_cnt_to_check_, max_tx_cnt_to_check, max_nfts_to_process,
+        scheduler: AdaptiveScheduler
 ):
-
-    background_tasks = list()
-
-    workers = min(worker_count, len(owned_nfts))
+    solana_client = await get_async_client()
 
     nft_mint_addresses = [k for k in owned_nfts.keys()]
     nft_mint_addresses = nft_mint_addresses[:max_nfts_to_process]
 
-    index_base = 0
-    for batch in split(nft_mint_addresses, workers):
-        background_tasks.append(_get_nft_last_sale(batch,
-                                                   index_base,
-                                                   nft_treasuries,
-                                                   tx_cnt_to_check_,
-                                                   max_tx_cnt_to_check)
-                                )
-        index_base += len(batch)
-
-    results = await asyncio.gather(*background_tasks)
-    combined = sum(results, [])
+    # all NFTs are scanned concurrently, the scheduler decides how many RPC requests are actually in flight.
+    # If one scan fails, the others are cancelled rather than left running for a response nobody waits for
+    results = await gather_or_cancel(*[
+        _get_nft_last_sale(solana_client,
+                           scheduler,
+                           nft_index,
+                           nft_mint_address,
+                           nft_treasuries,
+                           tx_cnt_to_check_,
+                           max_tx_cnt_to_check)
+        for nft_index, nft_mint_address in enumerate(nft_mint_addresses)
+    ])
+    combined = [tx for tx in results if tx]
     for tx in combined:
         tx.sold_nft_name = owned_nfts[str(tx.nft_mint)]
     return combined
+
+
+async def stream_nft_last_sales(
+        owned_nfts, nft_treasuries, tx_cnt_to_check_, max_tx_cnt_to_check, max_nfts_to_process,
+        scheduler: AdaptiveScheduler
+):
+    """
+    Same as get_nft_last_sale_batch, but yields each last sale as soon as it is found (in no particular order).
+    Scans still running are cancelled if the consumer stops early.
+    """
+    solana_client = await get_async_client()
+
+    nft_mint_addresses = [k for k in owned_nfts.keys()]
+    nft_mint_addresses = nft_mint_addresses[:max_nfts_to_process]
+
+    tasks = [
+        asyncio.ensure_future(_get_nft_last_sale(solana_client,
+                                                 scheduler,
+                                                 nft_index,
+                                                 nft_mint_address,
+                                                 nft_treasuries,
+                                                 tx_cnt_to_check_,
+                                                 max_tx_cnt_to_check))
+        for nft_index, nft_mint_address in enumerate(nft_mint_addresses)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            tx = await next_done
+            if tx:
+                tx.sold_nft_name = owned_nfts[str(tx.nft_mint)]
+                yield tx
+    finally:
+        cancel_tasks(tasks)
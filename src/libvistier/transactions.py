@@ -0,0 +1,85 @@
+import os
+import asyncio
+import threading
+import weakref
+
+from solana.rpc.commitment import Finalized
+from solders.rpc.responses import GetTransactionResp
+from solders.signature import Signature
+
+from .caches import TransactionCache, get_cache_path
+
+TRANSACTION_CACHE_FILE = "transactions.sqlite"
+
+# upper bound of the (compressed) transaction cache size, in MB
+TRANSACTION_CACHE_MAX_MB_ENV = 'VISTIER_TX_CACHE_MAX_MB'
+TRANSACTION_CACHE_DEFAULT_MAX_MB = 512
+
+_transaction_cache = None
+
+# event loop -> signature -> fetch in flight, concurrent requests for the same signature (e.g. the wallets of a batch)
+# share it. A future can only be awaited from its own loop, so each loop (server thread) has its own fetches
+_in_flight = weakref.WeakKeyDictionary()
+_in_flight_lock = threading.Lock()
+
+
+def get_transaction_cache() -> TransactionCache:
+    # created lazily so that the cache location can be configured (e.g. via .env) after import
+    global _transaction_cache
+    if _transaction_cache is None:
+        max_mb = int(os.environ.get(TRANSACTION_CACHE_MAX_MB_ENV, TRANSACTION_CACHE_DEFAULT_MAX_MB))
+        _transaction_cache = TransactionCache(max_bytes=max_mb * 1024 * 1024,
+                                              path=get_cache_path(TRANSACTION_CACHE_FILE))
+    return _transaction_cache
+
+
+def transaction_cache_stats() -> dict:
+    return get_transaction_cache().stats()
+
+
+async def get_transaction(solana_client, tx_sig: Signature) -> GetTransactionResp:
+    """
+    Drop-in for solana_client.get_transaction that serves repeated signatures from the transaction cache.
+    Concurrent requests for the same signature share a single fetch.
+    Only transactions found at the finalized commitment are cached, as only those can never change.
+    """
+    transaction_cache = get_transaction_cache()
+    signature = str(tx_sig)
+    loop = asyncio.get_running_loop()
+
+    if transaction_cache.persistent:
+        raw = await loop.run_in_executor(None, transaction_cache.get, signature)
+    else:
+        raw = transaction_cache.get(signature)
+    if raw is not None:
+        return GetTransactionResp.from_json(raw)
+
+    with _in_flight_lock:
+        loop_in_flight = _in_flight.setdefault(loop, dict())
+    fetch = loop_in_flight.get(signature)
+    if fetch is None:
+        fetch = asyncio.ensure_future(_fetch_transaction(solana_client, tx_sig))
+        loop_in_flight[signature] = fetch
+        fetch.add_done_callback(lambda done: _forget_fetch(loop_in_flight, signature, done))
+    # a caller giving up (cancelled) must not cancel the fetch for the others
+    return await asyncio.shield(fetch)
+
+
+def _forget_fetch(loop_in_flight: dict, signature: str, fetch: asyncio.Future) -> None:
+    if loop_in_flight.get(signature) is fetch:
+        del loop_in_flight[signature]
+    if not fetch.cancelled():
+        # all callers may have given up, mark the error as seen so it is not reported as never retrieved
+        fetch.exception()
+
+
+async def _fetch_transaction(solana_client, tx_sig: Signature) -> GetTransactionResp:
+    tx_response: GetTransactionResp = await solana_client.get_transaction(tx_sig=tx_sig)
+    if tx_response.value is not None and solana_client.commitment == Finalized:
+        transaction_cache = get_transaction_cache()
+        if transaction_cache.persistent:
+            await asyncio.get_running_loop().run_in_executor(None, transaction_cache.put, str(tx_sig),
+                                                             tx_response.to_json())
+        else:
+            transaction_cache.put(str(tx_sig), tx_response.to_json())
+    return tx_response
@@ -1,7 +1,11 @@
 import os
 import sys
+import asyncio
 import json
+import queue
+import atexit
 import logging
+import logging.handlers
 
 from colorama import Fore, Style, init as colorama_init
 from solders.rpc.responses import GetTransactionResp
@@ -10,6 +14,17 @@ colorama_init()
 
 DEBUG_LOG_FILE = False
 
+# set to "json" to log one JSON object per line (e.g. for log aggregators) instead of colored text
+LOG_FORMAT_ENV = 'VISTIER_LOG_FORMAT'
+
+# per transaction progress lines of the escrow and sales scans are only logged for 1 in this many transactions.
+# 1 logs every transaction. Errors are always logged
+LOG_TX_SAMPLE_RATE_ENV = 'VISTIER_LOG_TX_SAMPLE_RATE'
+DEFAULT_LOG_TX_SAMPLE_RATE = 10
+
+_log_tx_sample_rate = None
+_log_listener = None
+
 
 class CustomFormatter(logging.Formatter):
 
@@ -23,12 +38,73 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: Fore.LIGHTRED_EX + print_format + Style.RESET_ALL
     }
 
+    def __init__(self):
+        super().__init__(self.print_format)
+        self.formatters = {level: logging.Formatter(log_fmt) for level, log_fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.formatters.get(record.levelno, super())
         return formatter.format(record)
 
 
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class _EnvFormatter(logging.Formatter):
+    """
+    Chooses between JsonFormatter and CustomFormatter (see LOG_FORMAT_ENV) when the first record is written, not
+    when the first logger is created at import time, so that the format can also be set via .env.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._formatter = None
+
+    def format(self, record):
+        if self._formatter is None:
+            if os.environ.get(LOG_FORMAT_ENV, "").lower() == "json":
+                self._formatter = JsonFormatter()
+            else:
+                self._formatter = CustomFormatter()
+        return self._formatter.format(record)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records over to the listener thread as they are: the message is only formatted there, off the event loop.
+    Only the traceback is rendered here, as the exception may not outlive the except block.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _get_log_listener(handlers) -> logging.handlers.QueueListener:
+    # a single writer thread for all loggers, flushed and stopped at exit
+    global _log_listener
+    if _log_listener is None:
+        _log_listener = logging.handlers.QueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+    return _log_listener
+
+
 def get_logger(name):
 
     logger = logging.getLogger(name)
@@ -38,22 +114,66 @@ def get_logger(name):
 
     logger.setLevel(logging.DEBUG)
 
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setLevel(logging.INFO)
-    stdout_handler.setFormatter(CustomFormatter())
+    if _log_listener is None:
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.setLevel(logging.INFO)
+        stdout_handler.setFormatter(_EnvFormatter())
+        handlers = [stdout_handler]
 
-    if DEBUG_LOG_FILE:
-        formatter = logging.Formatter('%(asctime)s [%(levelname)7s][%(name)s]: %(message)s')
-        file_handler = logging.FileHandler("debug_log.txt", encoding='utf8')
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        if DEBUG_LOG_FILE:
+            formatter = logging.Formatter('%(asctime)s [%(levelname)7s][%(name)s]: %(message)s')
+            file_handler = logging.FileHandler("debug_log.txt", encoding='utf8')
+            file_handler.setLevel(logging.DEBUG)
+            file_handler.setFormatter(formatter)
+            handlers.append(file_handler)
 
-    logger.addHandler(stdout_handler)
+        _get_log_listener(handlers)
+
+    queue_handler = _DeferredQueueHandler(_log_listener.queue)
+    # records no handler would write are dropped before they are queued
+    queue_handler.setLevel(min(handler.level for handler in _log_listener.handlers))
+    logger.addHandler(queue_handler)
 
     return logger
 
 
+def log_tx_sampled(index: int) -> bool:
+    """
+    True if the progress of the index-th transaction of a scan is to be logged, see LOG_TX_SAMPLE_RATE_ENV.
+    """
+    global _log_tx_sample_rate
+    if _log_tx_sample_rate is None:
+        _log_tx_sample_rate = max(1, int(os.environ.get(LOG_TX_SAMPLE_RATE_ENV, DEFAULT_LOG_TX_SAMPLE_RATE)))
+    return index % _log_tx_sample_rate == 0
+
+
+async def gather_or_cancel(*coroutines) -> list:
+    """
+    Like asyncio.gather, but once one of them fails (or the caller is cancelled) the others are cancelled
+    instead of being left running in the background.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # wait for the cancellations and retrieve their errors, only the first failure is raised
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def cancel_tasks(tasks) -> None:
+    """
+    Cancels the tasks a scan stopped waiting for. Those already failed have their error retrieved, so that it is not
+    reported as never retrieved.
+    """
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()
+
+
 def dump_transaction_data(tx_response: GetTransactionResp):
     txs = json.loads(tx_response.to_json())
     print(json.dumps(txs, indent=4))
@@ -63,3 +183,7 @@ def split(list_, parts_cnt):
     # https://stackoverflow.com/questions/2130016/splitting-a-list-into-n-parts-of-approximately-equal-length
     k, m = divmod(len(list_), parts_cnt)
     return (list_[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(parts_cnt))
+
+
+def chunks(list_, chunk_size):
+    return (list_[i:i + chunk_size] for i in range(0, len(list_), chunk_size))
@@ -0,0 +1,227 @@
+import json
+import time
+import asyncio
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from solders.pubkey import Pubkey
+from solders.rpc.requests import GetAccountInfo, GetBalance
+from solders.rpc.responses import GetAccountInfoResp, GetBalanceResp
+
+from libvistier.clients import RpcEndpoint, RpcRouter
+
+
+class FakeEndpoint:
+    """
+    JSON-RPC endpoint answering every request after delay seconds, with status (and an empty result on 200).
+    """
+
+    def __init__(self, status: int = 200, delay: float = 0.0):
+        self.status = status
+        self.delay = delay
+        self.posts = 0
+        self.answered = 0
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                outer.posts += 1
+                time.sleep(outer.delay)
+                if outer.status == 200:
+                    result = {"context": {"slot": 1}, "value": None}
+                    if request['method'] == "getBalance":
+                        result["value"] = 0
+                    body = json.dumps({"jsonrpc": "2.0", "id": request['id'], "result": result}).encode()
+                else:
+                    body = b'{"error": "failed"}'
+                try:
+                    self.send_response(outer.status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    outer.answered += 1
+                except OSError:
+                    # the client went away, e.g. a cancelled hedge
+                    pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_endpoints():
+    started = []
+
+    def start(**kwargs):
+        fake = FakeEndpoint(**kwargs)
+        started.append(fake)
+        return fake
+
+    yield start
+    for fake in started:
+        fake.close()
+
+
+def _endpoint(fake: FakeEndpoint, weight: float = 1, rate_limit: float = 0) -> RpcEndpoint:
+    return RpcEndpoint(fake.url, weight=weight, rate_limit=rate_limit, pool_size=4, timeout=5)
+
+
+async def _close(router: RpcRouter):
+    for endpoint in router.endpoints:
+        await endpoint.provider.session.aclose()
+
+
+def _account_info(router: RpcRouter):
+    return router.make_request(GetAccountInfo(Pubkey.new_unique()), GetAccountInfoResp)
+
+
+def _train_latency(endpoint: RpcEndpoint, latency: float):
+    # enough samples for the hedging percentile to be used
+    for _ in range(RpcEndpoint.MIN_HEDGE_SAMPLES):
+        endpoint.record_success(latency)
+
+
+def test_fails_over_when_endpoint_throttles(fake_endpoints):
+    throttling, healthy = fake_endpoints(status=429), fake_endpoints()
+
+    async def scenario():
+        router = RpcRouter([_endpoint(throttling, weight=1000), _endpoint(healthy, weight=0.001)], hedge_percentile=0)
+        try:
+            response = await _account_info(router)
+        finally:
+            await _close(router)
+        return router, response
+
+    router, response = asyncio.run(scenario())
+    assert isinstance(response, GetAccountInfoResp)
+    assert throttling.posts == 1 and healthy.posts == 1
+    assert router.failovers == 1
+    assert router.endpoints[0].failures == 1 and router.endpoints[0].success_rate < 1
+
+
+def test_does_not_fail_over_on_client_errors(fake_endpoints):
+    rejecting, healthy = fake_endpoints(status=400), fake_endpoints()
+
+    async def scenario():
+        router = RpcRouter([_endpoint(rejecting, weight=1000), _endpoint(healthy, weight=0.001)], hedge_percentile=0)
+        try:
+            with pytest.raises(Exception):
+                await _account_info(router)
+        finally:
+            await _close(router)
+        return router
+
+    router = asyncio.run(scenario())
+    assert rejecting.posts == 1 and healthy.posts == 0
+    assert router.failovers == 0
+
+
+def test_raises_when_every_endpoint_fails(fake_endpoints):
+    first, second = fake_endpoints(status=500), fake_endpoints(status=429)
+
+    async def scenario():
+        router = RpcRouter([_endpoint(first), _endpoint(second)], hedge_percentile=0)
+        try:
+            with pytest.raises(Exception):
+                await _account_info(router)
+        finally:
+            await _close(router)
+        return router
+
+    router = asyncio.run(scenario())
+    assert first.posts == 1 and second.posts == 1
+    assert router.failovers == 1
+
+
+def test_hedges_slow_request_and_cancels_the_loser(fake_endpoints):
+    slow, fast = fake_endpoints(delay=0.5), fake_endpoints()
+
+    async def scenario():
+        router = RpcRouter([_endpoint(slow, weight=1000), _endpoint(fast, weight=0.001)], hedge_percentile=90)
+        _train_latency(router.endpoints[0], 0.01)
+        try:
+            started = time.monotonic()
+            response = await _account_info(router)
+            elapsed = time.monotonic() - started
+            # the losing request must not be left running (or be recorded) once the hedge won,
+            # its cancellation completes on the next iterations of the loop
+            await asyncio.sleep(0.05)
+            leftover = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            requests = router.endpoints[0].requests
+            await asyncio.sleep(0.6)
+        finally:
+            await _close(router)
+        return router, response, elapsed, leftover, requests
+
+    router, response, elapsed, leftover, requests = asyncio.run(scenario())
+    assert isinstance(response, GetAccountInfoResp)
+    assert elapsed < 0.3
+    assert router.hedged == 1
+    assert slow.posts == 1 and fast.posts == 1
+    assert not leftover
+    assert router.endpoints[0].requests == requests == RpcEndpoint.MIN_HEDGE_SAMPLES
+
+
+def test_does_not_hedge_requests_with_side_effects(fake_endpoints):
+    slow, fast = fake_endpoints(delay=0.3), fake_endpoints()
+
+    async def scenario():
+        router = RpcRouter([_endpoint(slow, weight=1000), _endpoint(fast, weight=0.001)], hedge_percentile=90)
+        _train_latency(router.endpoints[0], 0.01)
+        try:
+            response = await router.make_request(GetBalance(Pubkey.new_unique()), GetBalanceResp)
+        finally:
+            await _close(router)
+        return router, response
+
+    router, response = asyncio.run(scenario())
+    assert isinstance(response, GetBalanceResp)
+    assert router.hedged == 0
+    assert slow.posts == 1 and fast.posts == 0
+
+
+def test_distributes_requests_by_weight(fake_endpoints):
+    heavy, light = fake_endpoints(), fake_endpoints()
+
+    async def scenario():
+        router = RpcRouter([_endpoint(heavy, weight=3), _endpoint(light, weight=1)], hedge_percentile=0)
+        await _close(router)
+        return router
+
+    router = asyncio.run(scenario())
+    picks = Counter(router.choose_now(set(), 1) for _ in range(4000))
+    assert 0.70 < picks[router.endpoints[0]] / 4000 < 0.80
+
+    # an unhealthy endpoint gets no traffic while a healthy one is left
+    router.endpoints[0].healthy = False
+    assert {router.choose_now(set(), 1) for _ in range(100)} == {router.endpoints[1]}
+
+
+def test_spent_request_budget_moves_traffic(fake_endpoints):
+    limited, other = fake_endpoints(), fake_endpoints()
+
+    async def scenario():
+        router = RpcRouter([_endpoint(limited, weight=1000, rate_limit=5), _endpoint(other, weight=0.001)],
+                           hedge_percentile=0)
+        await _close(router)
+        return router
+
+    router = asyncio.run(scenario())
+    picks = Counter(router.choose_now(set(), 1) for _ in range(20))
+    assert picks[router.endpoints[0]] == 5
+    assert picks[router.endpoints[1]] == 15
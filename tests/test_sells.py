@@ -0,0 +1,101 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from solders.signature import Signature
+
+from libvistier import sells
+from libvistier.caches import LastSaleIndex
+from libvistier.marketplace import SaleRecord
+from libvistier.scheduler import AdaptiveScheduler
+
+MINT = "7Kd3NpYd7rQqFGYjUzUcEmwY6vCXKQj4NzXDmAWwLyVm"
+TREASURIES = ["11111111111111111111111111111112"]
+
+
+def _sale(signature: Signature) -> SaleRecord:
+    return SaleRecord({"signature": str(signature), "block_time": 1668283175, "mint": MINT, "name": None,
+                       "source": "MagicEden", "price": 10 ** 9, "creator_fee_paid": 0, "market_fee_paid": 0,
+                       "seller": "seller", "buyer": "buyer", "type": "sale"})
+
+
+class FakeSolanaClient:
+    """
+    Serves getSignaturesForAddress of a single mint out of history, newest first.
+    """
+
+    def __init__(self, history):
+        self.history = history
+        self.queries = []
+
+    async def get_signatures_for_address(self, account, before=None, until=None, limit=None):
+        self.queries.append((before, until, limit))
+        start = self.history.index(before) + 1 if before else 0
+        end = self.history.index(until) if until in self.history else len(self.history)
+        page = self.history[start:end][:limit]
+        return SimpleNamespace(value=[SimpleNamespace(signature=signature, block_time=1668283175)
+                                      for signature in page])
+
+
+@pytest.fixture
+def last_sale_index(monkeypatch):
+    index = LastSaleIndex()
+    monkeypatch.setattr(sells, "_last_sale_index", index)
+    return index
+
+
+@pytest.fixture
+def sales(monkeypatch):
+    sold = set()
+
+    async def get_sale(solana_client, tx_sig, nft_treasuries):
+        return _sale(tx_sig) if tx_sig in sold else None
+
+    monkeypatch.setattr(sells, "get_sale", get_sale)
+    return sold
+
+
+def _scan(solana_client, tx_cnt_to_check):
+    return asyncio.run(sells._scan_nft_last_sale(solana_client, AdaptiveScheduler(4, 32, 0), 0, MINT, TREASURIES,
+                                                 tx_cnt_to_check, 1000))
+
+
+def test_full_page_without_sale_short_of_checkpoint_keeps_checkpoint(last_sale_index, sales):
+    newer = [Signature.new_unique() for _ in range(10)]
+    checkpoint = Signature.new_unique()
+    indexed_sale = _sale(Signature.new_unique()).to_dict()
+    last_sale_index.put(MINT, str(checkpoint), indexed_sale)
+    # the sale sits past the first page, between the page and the checkpoint
+    sales.add(newer[7])
+    client = FakeSolanaClient(newer + [checkpoint, Signature.new_unique()])
+
+    assert _scan(client, 5) is None
+    assert last_sale_index.get(MINT) == (str(checkpoint), indexed_sale)
+
+    sale = _scan(client, 20)
+    assert sale.sell_signature == str(newer[7])
+    assert last_sale_index.get(MINT) == (str(newer[0]), sale.to_dict())
+
+
+def test_checkpoint_on_page_boundary_reuses_indexed_sale(last_sale_index, sales):
+    newer = [Signature.new_unique() for _ in range(5)]
+    checkpoint = Signature.new_unique()
+    indexed_sale = _sale(Signature.new_unique()).to_dict()
+    last_sale_index.put(MINT, str(checkpoint), indexed_sale)
+    client = FakeSolanaClient(newer + [checkpoint, Signature.new_unique()])
+
+    sale = _scan(client, 5)
+    assert sale is not None and sale.to_dict() == indexed_sale
+    assert last_sale_index.get(MINT) == (str(newer[0]), indexed_sale)
+
+    # the next query starts from the moved checkpoint and has nothing newer to check
+    assert _scan(client, 5).to_dict() == indexed_sale
+    assert client.queries[-1] == (None, newer[0], 5)
+
+
+def test_history_start_on_page_boundary_records_no_sale(last_sale_index, sales):
+    history = [Signature.new_unique() for _ in range(5)]
+    client = FakeSolanaClient(history)
+
+    assert _scan(client, 5) is None
+    assert last_sale_index.get(MINT) == (str(history[0]), None)